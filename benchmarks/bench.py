@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+""" Offline benchmarks for gsh's core, using the local executor.
+
+No remote hosts are needed: hosts are run by LocalExecutor in synthetic
+mode, which fakes latency and output without starting any processes, so
+what's measured is gsh's own overhead. Cases:
+
+    overhead  Per-host cost of scheduling, hooks and bookkeeping.
+    lines     Lines per second through update_host and PrinterHook.
+    memory    Memory held per in-flight host.
+    startup   Wall time of bin/gsh running a job end to end.
+
+Each case runs at every size given with --hosts.
+
+Usage: python benchmarks/bench.py [--hosts 10,1000,10000] [case ...]
+"""
+
+import argparse
+import gc
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import gevent
+
+from gsh import Gsh
+from gsh.plugin import BaseExecutionHook, get_executors, get_hooks
+
+
+class CountingHook(BaseExecutionHook):
+    """ Counts the lines it is handed one at a time."""
+
+    def __init__(self):
+        self.lines = 0
+
+    def update_host(self, hostname, stream, line):
+        self.lines += 1
+
+
+def _hosts(count):
+    return ["host%05d.example.com" % num for num in xrange(count)]
+
+
+def _executor(**kwargs):
+    kwargs.setdefault("mode", "synthetic")
+    return get_executors().LocalExecutor([], kwargs)
+
+
+def _run(hosts, fork_limit=64, hooks=None, **kwargs):
+    gsh = Gsh(hosts, ["true"], fork_limit=fork_limit, hooks=hooks,
+              executor=_executor(**kwargs))
+    start = time.time()
+    gsh.run_async()
+    gsh.wait()
+    return time.time() - start
+
+
+def _rss():
+    """ Current resident set size in bytes."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # Peak rather than current, but all that's available off Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bench_overhead(count):
+    elapsed = _run(_hosts(count))
+    return "%8.1fus/host  (%.3fs total)" % (elapsed / count * 1e6, elapsed)
+
+
+def bench_lines(count):
+    lines = max(100000 // count, 10)
+    total = count * lines
+
+    counter = CountingHook()
+    elapsed = _run(_hosts(count), hooks=[counter], lines=lines)
+    results = ["update_host %9.0f lines/s" % (counter.lines / elapsed)]
+
+    printer = get_hooks().PrinterHook(prepend_host=True)
+    stdout = sys.stdout
+    with open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            elapsed = _run(_hosts(count), hooks=[printer], lines=lines)
+        finally:
+            sys.stdout = stdout
+    results.append("PrinterHook %9.0f lines/s" % (total / elapsed))
+
+    return "  ".join(results) + "  (%d lines/host)" % lines
+
+
+def bench_memory(count):
+    hosts = _hosts(count)
+    latency = 0.5 + count / 5000.0
+    gc.collect()
+    before = _rss()
+    samples = []
+
+    def _sample():
+        # Sample once every host should be in flight.
+        gevent.sleep(latency * 0.8)
+        samples.append(_rss())
+
+    sampler = gevent.spawn(_sample)
+    _run(hosts, fork_limit=count, latency=latency, lines=1)
+    sampler.join()
+
+    return "%8.1fKiB/host" % (float(samples[0] - before) / count / 1024)
+
+
+def bench_startup(count):
+    with tempfile.NamedTemporaryFile(prefix="gsh-bench-") as host_file:
+        host_file.write("\n".join(_hosts(count)))
+        host_file.flush()
+
+        home = tempfile.mkdtemp(prefix="gsh-bench-")
+        env = dict(os.environ, HOME=home, PYTHONPATH=ROOT)
+        command = [sys.executable, os.path.join(ROOT, "bin", "gsh"), "-f", host_file.name,
+                   "-e", "local:mode=synthetic", "-F", "64", "true"]
+        with open(os.devnull, "w") as devnull:
+            # The first run builds the plugin manifest.
+            subprocess.call(command, env=env, stdout=devnull, stderr=devnull)
+            start = time.time()
+            subprocess.call(command, env=env, stdout=devnull, stderr=devnull)
+            elapsed = time.time() - start
+        subprocess.call(["rm", "-rf", home])
+
+    return "%8.3fs" % elapsed
+
+
+CASES = [
+    ("overhead", bench_overhead),
+    ("lines", bench_lines),
+    ("memory", bench_memory),
+    ("startup", bench_startup),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark gsh with a local executor.")
+    parser.add_argument("--hosts", default="10,1000,10000",
+                        help="Comma separated host counts to run each case at.")
+    parser.add_argument("cases", nargs="*", default=[name for name, _ in CASES],
+                        help="Cases to run: %s" % ", ".join(name for name, _ in CASES))
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.hosts.split(",")]
+    for name, bench in CASES:
+        if name not in args.cases:
+            continue
+        for size in sizes:
+            print "%-8s %6d hosts: %s" % (name, size, bench(size))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
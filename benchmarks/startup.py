@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+""" Measure how long gsh takes to start up.
+
+Runs bin/gsh repeatedly with a throwaway HOME and reports the best and
+median wall clock time for printing the version, printing help (which
+needs every plugin's options) with and without a plugin manifest cached,
+and discovering plugins in-process eagerly versus lazily.
+
+Usage: python benchmarks/startup.py [-n RUNS]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GSH = os.path.join(ROOT, "bin", "gsh")
+
+sys.path.insert(0, ROOT)
+
+
+def _time_gsh(args, env, runs, before=None):
+    timings = []
+    with open(os.devnull, "w") as devnull:
+        for _ in xrange(runs):
+            if before is not None:
+                before()
+            start = time.time()
+            subprocess.call([sys.executable, GSH] + args, env=env,
+                            stdout=devnull, stderr=devnull)
+            timings.append(time.time() - start)
+    return timings
+
+
+def _time_discovery(lazy, cache_dir, runs):
+    from gsh.plugin import get_loaders, get_hooks, get_executors
+
+    timings = []
+    for _ in xrange(runs):
+        start = time.time()
+        for get_plugins in (get_loaders, get_hooks, get_executors):
+            get_plugins(lazy=lazy, cache_dir=cache_dir)
+        timings.append(time.time() - start)
+    return timings
+
+
+def _report(name, timings):
+    timings = sorted(timings)
+    print "%-32s best %7.1fms  median %7.1fms" % (
+        name, timings[0] * 1000, timings[len(timings) // 2] * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure gsh start up time.")
+    parser.add_argument("-n", "--runs", type=int, default=10,
+                        help="How many times to run each case.")
+    args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix="gsh-bench-")
+    cache_dir = os.path.join(home, ".gsh", "cache")
+    env = dict(os.environ, HOME=home, PYTHONPATH=ROOT)
+
+    def _drop_manifest():
+        shutil.rmtree(os.path.join(cache_dir, "plugins"), ignore_errors=True)
+
+    try:
+        _report("gsh -V", _time_gsh(["-V"], env, args.runs))
+        _report("gsh -h (no manifest)", _time_gsh(["-h"], env, args.runs, _drop_manifest))
+        _report("gsh -h (cached manifest)", _time_gsh(["-h"], env, args.runs))
+        _report("discovery (eager)", _time_discovery(False, cache_dir, args.runs))
+        _report("discovery (lazy)", _time_discovery(True, cache_dir, args.runs))
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+""" On-disk caching of the hosts returned by loaders."""
+
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import time
+
+
+DEFAULT_CACHE_DIR = "~/.gsh/cache"
+
+
+class HostCache(object):
+    """ Caches the hosts resolved by loaders between runs.
+
+    Entries are keyed by the loader and the arguments it was called with and
+    stored as JSON under <cache_dir>/hosts. Loaders opt in through
+    BaseHostLoader: file based loaders return the files they read from
+    cache_dependencies() and entries are thrown away as soon as one of those
+    files changes, appears or disappears. Dynamic loaders, which might be
+    backed by an inventory service, set cache_ttl to the number of seconds
+    their results remain good for. Loaders doing neither are never cached.
+
+    Attributes:
+        cache_dir: Directory cache entries are kept in.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = os.path.join(os.path.expanduser(cache_dir), "hosts")
+
+    def load(self, loader, args):
+        """ Returns loader(*args), from the cache when possible."""
+        ttl = getattr(loader, "cache_ttl", None)
+        dependencies = getattr(loader, "cache_dependencies", lambda *args: None)(*args)
+        if ttl is None and dependencies is None:
+            return loader(*args)
+
+        mtimes = None
+        if dependencies is not None:
+            mtimes = self._mtimes(dependencies)
+            # Pipes and devices (e.g. -f /dev/stdin) can't be cached.
+            if mtimes is None:
+                return loader(*args)
+
+        path = self._path(loader, args)
+        entry = self._read(path)
+        if entry is not None and self._valid(entry, mtimes, ttl):
+            return [host.encode("utf-8") for host in entry["hosts"]]
+
+        # Loaders may return any iterable, including a generator.
+        hosts = list(loader(*args))
+        self._write(path, {
+            "hosts": hosts,
+            "created": time.time(),
+            "mtimes": mtimes,
+        })
+        return hosts
+
+    def _path(self, loader, args):
+        key = "%s:%r" % (type(loader).__name__, args)
+        return os.path.join(self.cache_dir, hashlib.sha1(key).hexdigest())
+
+    @staticmethod
+    def _mtimes(paths):
+        mtimes = {}
+        for path in paths:
+            try:
+                info = os.stat(path)
+            except OSError:
+                mtimes[path] = None
+                continue
+            if not stat.S_ISREG(info.st_mode):
+                return None
+            mtimes[path] = [info.st_mtime, info.st_size]
+        return mtimes
+
+    @staticmethod
+    def _valid(entry, mtimes, ttl):
+        if ttl is not None and time.time() - entry.get("created", 0) > float(ttl):
+            return False
+        if mtimes is not None and entry.get("mtimes") != mtimes:
+            return False
+        return True
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as cache_file:
+                entry = json.load(cache_file)
+        except (IOError, ValueError):
+            return None
+        if not isinstance(entry, dict) or "hosts" not in entry:
+            return None
+        return entry
+
+    def _write(self, path, entry):
+        # The cache is only an optimization so failing to write it is fine.
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, 0700)
+            with tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False) as cache_file:
+                json.dump(entry, cache_file)
+            os.rename(cache_file.name, path)
+        except (IOError, OSError):
+            pass
@@ -5,6 +5,9 @@ import yaml
 
 from .exceptions import ConfigError
 
+# The C parser is much quicker to load files with, when available.
+_SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 
 class Config(object):
     """ Configuration object for GSH.
@@ -16,15 +19,33 @@ class Config(object):
     the command line utility.
 
     Attributes:
-        forklimit: The number of concurrent processes to fork at a time.
+        forklimit: The number of concurrent processes to fork at a time. May be
+            "auto" or "auto:<initial>" to adapt the limit while running.
         print_machines: Whether to prefix output with machine names.
         print_output: Whether to print output from the executed commands.
         show_percent: Whether to prefix output with percentage of completion.
+        buffer_output: Whether to write output in large blocks rather than per line.
+        aggregate_output: Whether to group hosts with identical output and
+            print it once the job finishes instead of as it arrives.
         concurrent: Whether to perform operation sequentially vs concurrently.
         timeout: How long to wait for a command to finish on a host.
         plugin_dirs: Where to look for addition plugins.
         hooks: Which hooks to pass through to Gsh.
+        hook_options: A dict of hook name to keyword arguments for that hook.
         executor: Which executor to run the commands with.
+        loader_cache: Whether to cache hosts resolved by loaders between runs.
+        loader_timeout: How long to wait for each host loader.
+        cache_dir: Where cached data is kept.
+        canary: Hosts (a count or "N%") to run first, on their own, or None.
+        canary_failures: Canary hosts (a count or "N%") allowed to fail
+            before the rest of the job is skipped.
+        max_failures: Hosts (a count or "N%") allowed to fail before no more
+            are started, or None for no limit.
+        lpt_schedule: Whether to record how long hosts take and start those
+            expected to take longest first.
+        straggler_factor: Cut hosts running longer than this many times the
+            95th percentile of finished hosts, or None not to.
+        deadline: Most seconds the whole job may take, or None.
 
     """
 
@@ -33,13 +54,25 @@ class Config(object):
         self.print_machines = True
         self.print_output = True
         self.show_percent = False
+        self.buffer_output = False
+        self.aggregate_output = False
         self.concurrent = True
         self.timeout = 0
         self.plugin_dirs = set()
         self.hooks = set()
+        self.hook_options = {}
         self.executor = "ssh"
         self.executor_args = []
         self.executor_kwargs = {}
+        self.loader_cache = True
+        self.loader_timeout = None
+        self.cache_dir = "~/.gsh/cache"
+        self.canary = None
+        self.canary_failures = 0
+        self.max_failures = None
+        self.lpt_schedule = False
+        self.straggler_factor = None
+        self.deadline = None
 
     def __repr__(self):
         return (
@@ -54,7 +87,7 @@ class Config(object):
         """ Updates the configuration attributes from a file."""
         try:
             with open(config) as config_file:
-                data = yaml.safe_load(config_file)
+                data = yaml.load(config_file, Loader=_SafeLoader)
                 if not isinstance(data, dict):
                     data = {}
 
@@ -62,8 +95,19 @@ class Config(object):
             self.print_machines = data.get("print_machines", self.print_machines)
             self.print_output = data.get("print_output", self.print_output)
             self.show_percent = data.get("show_percent", self.show_percent)
+            self.buffer_output = data.get("buffer_output", self.buffer_output)
+            self.aggregate_output = data.get("aggregate_output", self.aggregate_output)
             self.concurrent = data.get("concurrent", self.concurrent)
             self.timeout = data.get("timeout", self.timeout)
+            self.loader_cache = data.get("loader_cache", self.loader_cache)
+            self.loader_timeout = data.get("loader_timeout", self.loader_timeout)
+            self.cache_dir = data.get("cache_dir", self.cache_dir)
+            self.canary = data.get("canary", self.canary)
+            self.canary_failures = data.get("canary_failures", self.canary_failures)
+            self.max_failures = data.get("max_failures", self.max_failures)
+            self.lpt_schedule = data.get("lpt_schedule", self.lpt_schedule)
+            self.straggler_factor = data.get("straggler_factor", self.straggler_factor)
+            self.deadline = data.get("deadline", self.deadline)
 
             self._parse_executor(data.get("executor", self.executor))
 
@@ -74,6 +118,12 @@ class Config(object):
 
             self._parse_hooks(data.get("hooks", []))
 
+            hook_options = data.get("hook_options", {})
+            if isinstance(hook_options, dict):
+                for hook, options in hook_options.iteritems():
+                    if isinstance(options, dict):
+                        self.hook_options.setdefault(hook, {}).update(options)
+
         # It's okay to ignore files that don't exist.
         except IOError:
             pass
@@ -93,6 +143,8 @@ class Config(object):
 
         for argument in arguments.split(","):
             argument = argument.strip()
+            if not argument:
+                continue
 
             if "=" in argument:
                 key, value = argument.split("=", 1)
@@ -120,24 +172,61 @@ class Config(object):
             else:
                 self.hooks.add(hook)
 
+    def _parse_hook_options(self, hook_options):
+        """ Parses hook option strings of the form hook:kwarg1=foo,kwarg2=bar. """
+        for hook_option in hook_options:
+            hook, _, arguments = hook_option.partition(":")
+            options = self.hook_options.setdefault(hook.strip(), {})
+            for argument in arguments.split(","):
+                if "=" not in argument:
+                    continue
+                key, value = argument.split("=", 1)
+                options[key.strip()] = value.strip()
+
     def update_from_args(self, args):
         """ Update config object from an argparse args object."""
 
         self.plugin_dirs.update(args.plugin_dirs)
         self._parse_hooks(getattr(args, "hooks", []))
+        self._parse_hook_options(getattr(args, "hook_options", []))
+
+        previous_forklimit = str(self.forklimit).split(":")[-1]
 
         if getattr(args, "forklimit", None) is not None:
             self.forklimit = args.forklimit
+            # A bare "auto" starts adapting from the previously configured limit.
+            if self.forklimit == "auto" and previous_forklimit != "auto":
+                self.forklimit = "auto:%s" % previous_forklimit
         if getattr(args, "print_machines", None) is not None:
             self.print_machines = args.print_machines
         if getattr(args, "print_output", None) is not None:
             self.print_output = args.print_output
         if getattr(args, "show_percent", None) is not None:
             self.show_percent = args.show_percent
+        if getattr(args, "buffer_output", None) is not None:
+            self.buffer_output = args.buffer_output
+        if getattr(args, "aggregate_output", None) is not None:
+            self.aggregate_output = args.aggregate_output
         if getattr(args, "concurrent", None) is not None:
             self.concurrent = args.concurrent
         if getattr(args, "timeout", None) is not None:
             self.timeout = args.timeout
+        if getattr(args, "loader_cache", None) is not None:
+            self.loader_cache = args.loader_cache
+        if getattr(args, "loader_timeout", None) is not None:
+            self.loader_timeout = args.loader_timeout
+        if getattr(args, "canary", None) is not None:
+            self.canary = args.canary
+        if getattr(args, "canary_failures", None) is not None:
+            self.canary_failures = args.canary_failures
+        if getattr(args, "max_failures", None) is not None:
+            self.max_failures = args.max_failures
+        if getattr(args, "straggler_factor", None) is not None:
+            self.straggler_factor = args.straggler_factor
+        if getattr(args, "deadline", None) is not None:
+            self.deadline = args.deadline
+        if getattr(args, "lpt_schedule", None) is not None:
+            self.lpt_schedule = args.lpt_schedule
         if getattr(args, "executor", None) is not None:
             self._parse_executor(args.executor)
         if getattr(args, "remoteshellopt", []):
@@ -1,10 +1,14 @@
 
 import gevent
-from gevent.pool import Pool
+from gevent.pool import Group
 import time
 
 from .plugin import get_executors
-from .exceptions import EarlyExit
+from .dispatch import HookDispatcher
+from .forklimit import ForkLimit, AdaptiveForkLimit
+from .journal import Journal
+from .metrics import HostMetrics
+from .profiling import Profiler
 
 
 class RemotePopen(object):
@@ -14,73 +18,200 @@ class RemotePopen(object):
     FAILED = 2
     SUCCESS = 3
 
-    def __init__(self, hostname, command, timeout=None, hooks=None, executor=None):
+    def __init__(self, hostname, command, timeout=None, hooks=None, executor=None,
+                 batch_size=512, batch_window=0.1):
         self.hostname = hostname
         self.command = command
         self.timeout = timeout
 
+        self._owns_executor = executor is None
         if executor is None:
-            executor = get_executors().SshExecutor([], {})
+            executor = get_executors(lazy=True).SshExecutor([], {})
+        self._parent_executor = executor
 
         self.executor = executor.Executor(
             executor, self.hostname, self.command, self.timeout,
             self._run_update_host_hooks
         )
 
+        # Shared with the executor, which marks what it can see of the host's
+        # progress on it.
+        self.metrics = HostMetrics(hostname)
+        self.executor.metrics = self.metrics
+
         # Treat 0 second timeouts as no timeout.
         if not timeout:
             self.timeout = None
 
+        # hooks may be a list of hooks or, when run as part of a Gsh job, the
+        # job's HookDispatcher.
         if hooks is None:
             hooks = []
-        self.hooks = hooks
+        self._owns_dispatcher = not isinstance(hooks, HookDispatcher)
+        if self._owns_dispatcher:
+            hooks = HookDispatcher(hooks)
+        self._dispatcher = hooks
+        self.hooks = hooks.hooks
+
+        # Hooks that want output in batches get lines coalesced for up to
+        # batch_size lines or batch_window seconds, whichever comes first.
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._wants_lines = self._dispatcher.wants_lines
+        self._wants_batches = self._dispatcher.wants_batches
+        self._batch = []
+        self._batch_flusher = None
 
         self.status = RemotePopen.QUEUED
+        self.cancelled = False
         self.rc = None
+        self.start_time = None
+        self.end_time = None
 
+    def _run_update_host_hooks(self, hostname, stream, line):
+        self.metrics.mark("first_byte")
+        self.metrics.count(stream, line)
 
-        self._pre_host_hooks = None
-        self._post_host_hooks = None
+        if self._wants_lines:
+            self._dispatcher.update_host(hostname, stream, line)
 
-    def _run_pre_host_hooks(self):
-        for hook in self.hooks:
-            hook.pre_host(self.hostname, time.time())
+        if not self._wants_batches:
+            return
 
-    def _run_post_host_hooks(self):
-        for hook in self.hooks:
-            hook.post_host(self.hostname, self.rc, time.time())
+        self._batch.append((stream, line))
+        if len(self._batch) >= self.batch_size:
+            self._flush_batch()
+        elif self._batch_flusher is None:
+            self._batch_flusher = gevent.spawn_later(self.batch_window, self._flush_batch_later)
 
-    def _run_update_host_hooks(self, hostname, stream, line):
-        for hook in self.hooks:
-            hook.update_host(hostname, stream, line)
+    def _flush_batch_later(self):
+        self._batch_flusher = None
+        self._flush_batch()
+
+    def _flush_batch(self):
+        if not self._batch:
+            return
+        lines, self._batch = self._batch, []
+        self._dispatcher.update_host_batch(self.hostname, lines)
 
     def run(self):
-        self._pre_host_hooks = gevent.spawn(self._run_pre_host_hooks)
-        self._pre_host_hooks.join()
+        self._dispatcher.pre_host(self.hostname, time.time())
 
         self.status = RemotePopen.RUNNING
 
+        self.start_time = time.time()
+        self.metrics.mark("started", self.start_time)
         self.rc = self.executor.run()
+        self.end_time = time.time()
+        self.metrics.mark("finished", self.end_time)
+
+        if self._batch_flusher is not None:
+            self._batch_flusher.kill()
+            self._batch_flusher = None
+        self._flush_batch()
 
         if not self.rc:
             self.status = RemotePopen.SUCCESS
         else:
             self.status = RemotePopen.FAILED
 
-        self._post_host_hooks = gevent.spawn(self._run_post_host_hooks)
-        self._post_host_hooks.join()
+        self._dispatcher.post_host(self.hostname, self.rc, time.time(), self.metrics)
+
+        if self._owns_dispatcher:
+            self._dispatcher.close()
+        if self._owns_executor:
+            self._parent_executor.close()
+
+    def cancel(self, message=None):
+        """ Stop the command, if it's running, through its executor.
+
+            The host still finishes as usual, with whatever return code the
+            executor reports for the killed command.
+
+            Args:
+                message: If given and the host is running, reported to the
+                    hooks as a line of its stderr saying why it was cancelled.
+        """
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self.status == RemotePopen.RUNNING:
+            if message is not None:
+                self._run_update_host_hooks(self.hostname, "stderr", message)
+            self.executor.cancel()
 
 
 class Gsh(object):
-    def __init__(self, hosts, command, fork_limit=1, timeout=None, hooks=None, executor=None):
-        self.hosts = set(hosts)
+    """ Runs a command across many hosts.
+
+    hosts may be any iterable, including a generator. Collections are
+    treated as a set, as they always have been. Other iterables are consumed
+    lazily, only as room frees up under the fork limit, and de-duplicated as
+    they go, so per-host state is only ever held for running hosts. As the
+    hosts aren't known up front, pre_job hooks are passed the set of hosts
+    seen so far, which starts out empty, and a percentage fork limit falls
+    back to running serially.
+
+    profile may be True to print a gsh.profiling.Profiler report to stderr
+    once the job finishes, a path to dump it to as JSON, or a Profiler.
+
+    journal may be a path (or gsh.journal.Journal) to record each host's
+    progress to. With resume the journal is one from an earlier, interrupted,
+    run of the same command and hosts which succeeded then are skipped.
+
+    policy is an optional gsh.policy.RunPolicy, for a canary batch and a
+    limit on failures. When it (or stop() or cancel()) ends the job early
+    hosts that were never started are passed to the hooks' skip_host and
+    listed in skipped, with the reason in stop_reason.
+
+    history is an optional gsh.history.DurationHistory. The duration of
+    each host that succeeds is recorded to it and, when the fork limit means
+    not every host can run at once, hosts expected to take longest are
+    started first.
+
+    stragglers is an optional gsh.stragglers.StragglerCutoff. Running hosts
+    taking longer than the cutoff it derives from succeeded hosts are
+    cancelled and listed in stragglers. deadline is the most seconds the
+    whole job may take, after which it's cancelled: hosts still running are
+    listed in deadline_cut and wait() returns DEADLINE_RC.
+    """
+
+    # Return code of a job cancelled at its deadline, as timeout(1) uses.
+    DEADLINE_RC = 124
+
+    def __init__(self, hosts, command, fork_limit=1, timeout=None, hooks=None, executor=None,
+                 profile=None, journal=None, resume=False, policy=None, history=None,
+                 stragglers=None, deadline=None):
+        self.journal = None
+        self.resume = resume
+        self.previously_succeeded = set()
+        if journal is not None:
+            self.journal = journal if isinstance(journal, Journal) else Journal(journal)
+            if resume:
+                self.previously_succeeded = self.journal.succeeded(command)
+
+        self._seen = None
+        self._num_hosts = None
+        if hasattr(hosts, "__len__"):
+            self.hosts = set(hosts) - self.previously_succeeded
+            num_hosts = self._num_hosts = len(self.hosts)
+        else:
+            self.hosts = hosts
+            self._seen = set()
+            num_hosts = 0
+
         self.command = command
-        self.fork_limit = self._build_fork_limit(fork_limit, len(self.hosts))
         self.timeout = timeout
 
+        # fork_limit may be "auto" (or "auto:<initial>") for a limit that
+        # adapts to how hosts are faring, rather than a fixed one.
+        self._limiter = self._build_limiter(fork_limit, num_hosts)
+        self.fork_limit = int(self._limiter.limit)
+
         self.executor = executor
+        self._owns_executor = executor is None
         if executor is None:
-            self.executor = get_executors().SshExecutor([], {})
+            self.executor = get_executors(lazy=True).SshExecutor([], {})
 
         # Treat 0 second timeouts as no timeout.
         if not timeout:
@@ -90,9 +221,38 @@ class Gsh(object):
             hooks = []
         self.hooks = hooks
 
-        self._pool = Pool(max(self.fork_limit, 1))
-        self._greenlets = []
-        self._remotes = []
+        self.profiler = None
+        self._profile_path = None
+        if isinstance(profile, Profiler):
+            self.profiler = profile
+        elif profile:
+            self.profiler = Profiler()
+            if isinstance(profile, basestring):
+                self._profile_path = profile
+
+        self._dispatcher = HookDispatcher(hooks, self.profiler)
+
+        self._scheduler = None
+        self._running = Group()
+        self._remotes = set()
+        self._failed = []
+        self._rc = 0
+
+        self.policy = policy
+
+        self.history = history
+        self._order = None
+
+        self.straggler_cutoff = stragglers
+        self.deadline = deadline or None
+        self.stragglers = []
+        self.deadline_reached = False
+        self.deadline_cut = []
+        self._monitor = None
+        self.stop_reason = None
+        self.skipped = []
+        self._started = 0
+        self._host_failures = 0
 
         self._pre_job_hooks = None
         self._post_job_hooks = None
@@ -108,39 +268,217 @@ class Gsh(object):
         # If we can't parse your forklimit go serial for safety.
         return 1
 
+    @staticmethod
+    def _build_limiter(fork_limit, num_hosts):
+        if isinstance(fork_limit, ForkLimit):
+            return fork_limit
+        if isinstance(fork_limit, basestring) and fork_limit.split(":")[0] == "auto":
+            initial = fork_limit[len("auto:"):] or str(AdaptiveForkLimit.DEFAULT_INITIAL)
+            return AdaptiveForkLimit(Gsh._build_fork_limit(initial, num_hosts))
+        return ForkLimit(Gsh._build_fork_limit(fork_limit, num_hosts))
+
     def run_async(self):
+        if self.journal is not None:
+            hosts = None if self._seen is not None else self.hosts | self.previously_succeeded
+            self.journal.begin(self.command, hosts, self.resume)
+
+        if self.profiler is not None:
+            self.profiler.start()
+
+        # Ordering only matters when hosts have to wait their turn.
+        if (self.history is not None and self._num_hosts is not None and
+                int(self._limiter.limit) < self._num_hosts):
+            self._order = self.history.order(self.command, self.hosts)
 
         # Don't start executing until the pre_job hooks have completed.
         self._pre_job_hooks = gevent.spawn(self._run_pre_job_hooks)
         self._pre_job_hooks.join()
 
-        if self._continue:
-            for host in self.hosts:
-                remote_command = RemotePopen(
-                    host, self.command, hooks=self.hooks,
-                    timeout=self.timeout, executor=self.executor)
-                self._remotes.append(remote_command)
-                self._greenlets.append(self._pool.apply_async(remote_command.run))
-
+        self._scheduler = gevent.spawn(self._schedule)
         self._post_job_hooks = gevent.spawn(self._run_post_job_hooks)
 
+        if self.straggler_cutoff is not None or self.deadline is not None:
+            self._monitor = gevent.spawn(self._watch_stragglers, time.time())
+
+    def _iter_hosts(self):
+        if self._seen is None:
+            for host in self._order or self.hosts:
+                yield host
+            return
+
+        for host in self.hosts:
+            if host in self._seen or host in self.previously_succeeded:
+                continue
+            self._seen.add(host)
+            yield host
+
+    def stop(self, reason="stopped"):
+        """ Stop starting hosts. Hosts already running are left to finish
+            while the rest are skipped.
+        """
+        if self.stop_reason is None:
+            self.stop_reason = reason
+
+    def cancel(self, reason="cancelled"):
+        """ Stop starting hosts and cancel those already running."""
+        self.stop(reason)
+        for remote_command in list(self._remotes):
+            remote_command.cancel()
+
+    def _watch_stragglers(self, started, interval=0.1):
+        """ Cancels hosts running past the straggler cutoff or the deadline."""
+        while True:
+            gevent.sleep(interval)
+            now = time.time()
+
+            if self.deadline is not None and now - started >= self.deadline:
+                self.deadline_reached = True
+                self.stop("job deadline of %g second(s) reached" % self.deadline)
+                message = "GSH: cancelled at the job deadline of %g second(s).\n" % self.deadline
+                for remote_command in list(self._remotes):
+                    if remote_command.cancelled:
+                        continue
+                    if remote_command.status == RemotePopen.RUNNING:
+                        self.deadline_cut.append(remote_command.hostname)
+                    remote_command.cancel(message)
+                return
+
+            cutoff = None
+            if self.straggler_cutoff is not None:
+                cutoff = self.straggler_cutoff.cutoff()
+            if cutoff is None:
+                continue
+
+            for remote_command in list(self._remotes):
+                if (remote_command.status == RemotePopen.RUNNING and
+                        not remote_command.cancelled and
+                        now - remote_command.start_time > cutoff):
+                    self.stragglers.append(remote_command.hostname)
+                    remote_command.cancel("GSH: cut as a straggler after %.1f second(s).\n" % (
+                        now - remote_command.start_time))
+
+    def _skip(self, host):
+        self.skipped.append(host)
+        self._dispatcher.skip_host(host, self.stop_reason)
+
+    def _schedule(self):
+        if not self._continue:
+            return
+
+        canary = self.policy.canary_size(self._num_hosts) if self.policy is not None else 0
+
+        for host in self._iter_hosts():
+            if canary and self._started == canary:
+                # Let the canary batch finish before deciding whether to
+                # carry on with everything else.
+                canary = 0
+                self._running.join()
+                if self.stop_reason is None:
+                    reason = self.policy.check_canary(self._host_failures, self._started)
+                    if reason is not None:
+                        self.stop(reason)
+
+            if self.stop_reason is not None:
+                self._skip(host)
+                continue
+
+            start = time.time()
+            self._limiter.acquire()
+            if self.profiler is not None:
+                self.profiler.record_pool_wait(time.time() - start)
+
+            # The job may have been stopped while we waited for room.
+            if self.stop_reason is not None:
+                self._limiter.cancel()
+                self._skip(host)
+                continue
+
+            self._started += 1
+            remote_command = RemotePopen(
+                host, self.command, hooks=self._dispatcher,
+                timeout=self.timeout, executor=self.executor)
+            self._remotes.add(remote_command)
+            greenlet = self._running.spawn(self._run_remote, remote_command)
+            greenlet.link_exception(self._failed.append)
+
+    def _run_remote(self, remote_command):
+        if remote_command.cancelled:
+            self._remotes.discard(remote_command)
+            self._limiter.cancel()
+            self._skip(remote_command.hostname)
+            return
+
+        if self.journal is not None:
+            self.journal.started(remote_command.hostname)
+        try:
+            remote_command.run()
+        finally:
+            self._remotes.discard(remote_command)
+            self._limiter.release(remote_command)
+            if self.journal is not None and remote_command.rc is not None:
+                self.journal.finished(remote_command.hostname, remote_command.rc)
+            if self.profiler is not None:
+                self.profiler.record_host(remote_command.metrics)
+            # Failures are often quick (say ssh failing to connect) and
+            # would skew how long the command takes, so only successes count.
+            if remote_command.rc == 0 and not remote_command.cancelled:
+                duration = remote_command.end_time - remote_command.start_time
+                if self.history is not None:
+                    self.history.record(self.command, remote_command.hostname, duration)
+                if self.straggler_cutoff is not None:
+                    self.straggler_cutoff.record(duration)
+
+        if remote_command.rc and not self._rc:
+            self._rc = remote_command.rc
+
+        if remote_command.rc:
+            self._host_failures += 1
+            if self.policy is not None and self.stop_reason is None:
+                total = self._num_hosts if self._num_hosts is not None else self._started
+                reason = self.policy.check_failures(self._host_failures, total)
+                if reason is not None:
+                    self.stop(reason)
+
     def _run_pre_job_hooks(self):
-        for hook in self.hooks:
-            try:
-                hook.pre_job(self.command, self.hosts, time.time())
-            except EarlyExit:
-                self._continue = False
+        hosts = self.hosts if self._seen is None else self._seen
+        self._continue = self._dispatcher.pre_job(self.command, hosts, time.time())
 
     def _run_post_job_hooks(self):
         # Wait for all greenlets to finish before running these hooks.
-        gevent.joinall(self._greenlets)
-        for hook in self.hooks:
-            hook.post_job(time.time())
+        self._scheduler.join()
+        self._running.join()
+        if self._monitor is not None:
+            self._monitor.kill()
+        self._dispatcher.post_job(time.time())
+        self.close()
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler.write(self._profile_path)
+
+    def close(self):
+        """ Flush the journal and duration history, if any, to disk and
+            release the executor if it was created for this job. Safe to
+            call more than once.
+        """
+        if self.journal is not None:
+            self.journal.close()
+        if self.history is not None:
+            self.history.save()
+        if self._owns_executor:
+            self.executor.close()
+
+    def hook_stats(self):
+        """ Returns queue depth and overflow counters for asynchronous hooks."""
+        return self._dispatcher.stats()
 
     def wait(self, timeout=None):
-        rc = 0
-        gevent.joinall(self._greenlets + [self._post_job_hooks], timeout=timeout, raise_error=True)
-        for remote in self._remotes:
-            if remote.rc:
-                return remote.rc
-        return rc
+        gevent.joinall([self._scheduler, self._post_job_hooks], timeout=timeout, raise_error=True)
+        # Surface any errors raised while running a host.
+        if self._failed:
+            self._failed[0].get()
+        if self.deadline_reached:
+            return Gsh.DEADLINE_RC
+        # Skipped hosts don't count against the job by themselves: a policy
+        # only stops it after hosts fail, and cut hosts fail as they're
+        # killed, so either way _rc is already set.
+        return self._rc
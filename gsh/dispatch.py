@@ -0,0 +1,233 @@
+""" Delivery of job and host events to execution hooks."""
+
+import sys
+import time
+import traceback
+
+import gevent
+from gevent.queue import Queue
+
+from .exceptions import EarlyExit
+from .plugin import overrides
+
+
+def _report_failure(hook, method):
+    """ Write the traceback of a hook which raised to stderr and carry on."""
+    sys.stderr.write("gsh: hook %s failed in %s\n" % (type(hook).__name__, method))
+    traceback.print_exc(file=sys.stderr)
+
+
+class _AsyncHookRunner(object):
+    """ Feeds a single asynchronous hook its events from a bounded queue.
+
+    Events are handled in the order they were queued, on a greenlet of the
+    hook's own, so a hook which blocks only holds up itself. When the queue
+    is full, output events are handled according to the hook's overflow
+    policy while every other event waits for room, so no host ever loses
+    its pre_host or post_host.
+
+    Attributes:
+        hook: The hook events are delivered to.
+        max_depth: The deepest the queue has been.
+        dropped: Output events discarded because of overflow.
+        processed: Events handed to the hook.
+    """
+
+    def __init__(self, hook, profiler=None):
+        self.hook = hook
+        self.profiler = profiler
+        self.max_depth = 0
+        self.dropped = 0
+        self.processed = 0
+
+        self._queue = Queue(max(hook.queue_size, 1))
+        self._sampled = 0
+        self._greenlet = None
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def put(self, method, args, droppable=False):
+        if droppable and self.hook.overflow != "block" and self._overflowing():
+            self.dropped += 1
+            return
+
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+
+        self._queue.put((method, args))
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+
+    def _overflowing(self):
+        if self._queue.full():
+            return True
+        # Sampling kicks in once the queue is half full, letting through
+        # one in every sample_rate output events until it drains.
+        if self.hook.overflow == "sample" and self._queue.qsize() * 2 >= self._queue.maxsize:
+            self._sampled += 1
+            return self._sampled % self.hook.sample_rate != 0
+        return False
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            method, args = item
+            start = time.time()
+            try:
+                getattr(self.hook, method)(*args)
+            except Exception:
+                _report_failure(self.hook, method)
+            if self.profiler is not None:
+                self.profiler.record_hook(self.hook, method, time.time() - start)
+            self.processed += 1
+
+    def close(self):
+        """ Wait for all queued events to be handled."""
+        if self._greenlet is None:
+            return
+        self._queue.put(None)
+        self._greenlet.join()
+        self._greenlet = None
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "dropped": self.dropped,
+            "processed": self.processed,
+        }
+
+
+class HookDispatcher(object):
+    """ Delivers events to a list of hooks.
+
+    Synchronous hooks are called inline, as they always have been.
+    Asynchronous hooks (those setting `asynchronous = True`) get their
+    events through an _AsyncHookRunner. Hooks are only called for output
+    if they override update_host or update_host_batch; those overriding
+    update_host_batch, and all asynchronous hooks, receive output in
+    batches.
+
+    Attributes:
+        hooks: All of the hooks events are delivered to.
+        profiler: An optional gsh.profiling.Profiler told how long each hook
+            method call took.
+    """
+
+    def __init__(self, hooks, profiler=None):
+        self.hooks = list(hooks)
+        self.profiler = profiler
+
+        self._sync_hooks = []
+        self._runners = []
+        for hook in self.hooks:
+            if getattr(hook, "asynchronous", False):
+                self._runners.append(_AsyncHookRunner(hook, profiler))
+            else:
+                self._sync_hooks.append(hook)
+
+        self._batch_hooks = [
+            hook for hook in self._sync_hooks if overrides(hook, "update_host_batch")
+        ]
+        self._line_hooks = [
+            hook for hook in self._sync_hooks
+            if overrides(hook, "update_host") and hook not in self._batch_hooks
+        ]
+        self._batch_runners = [
+            runner for runner in self._runners
+            if overrides(runner.hook, "update_host_batch") or overrides(runner.hook, "update_host")
+        ]
+
+    @staticmethod
+    def _post_host_args(hook, hostname, return_code, timestamp, metrics):
+        if getattr(hook, "wants_metrics", False):
+            return (hostname, return_code, timestamp, metrics)
+        return (hostname, return_code, timestamp)
+
+    @property
+    def wants_lines(self):
+        """ Whether any hook handles output one line at a time."""
+        return bool(self._line_hooks)
+
+    @property
+    def wants_batches(self):
+        """ Whether any hook handles output in batches."""
+        return bool(self._batch_hooks or self._batch_runners)
+
+    def _call(self, hook, method, *args):
+        start = time.time()
+        try:
+            getattr(hook, method)(*args)
+        except Exception:
+            _report_failure(hook, method)
+        if self.profiler is not None:
+            self.profiler.record_hook(hook, method, time.time() - start)
+
+    def pre_job(self, command, hosts, timestamp):
+        """ Run pre_job for every hook, inline.
+
+            Returns:
+                False if any hook raised EarlyExit.
+        """
+        proceed = True
+        for hook in self.hooks:
+            start = time.time()
+            try:
+                hook.pre_job(command, hosts, timestamp)
+            except EarlyExit:
+                proceed = False
+            if self.profiler is not None:
+                self.profiler.record_hook(hook, "pre_job", time.time() - start)
+        return proceed
+
+    def pre_host(self, hostname, timestamp):
+        for hook in self._sync_hooks:
+            self._call(hook, "pre_host", hostname, timestamp)
+        for runner in self._runners:
+            runner.put("pre_host", (hostname, timestamp))
+
+    def update_host(self, hostname, stream, line):
+        for hook in self._line_hooks:
+            self._call(hook, "update_host", hostname, stream, line)
+
+    def update_host_batch(self, hostname, lines):
+        for hook in self._batch_hooks:
+            self._call(hook, "update_host_batch", hostname, lines)
+        for runner in self._batch_runners:
+            runner.put("update_host_batch", (hostname, lines), droppable=True)
+
+    def post_host(self, hostname, return_code, timestamp, metrics=None):
+        for hook in self._sync_hooks:
+            self._call(hook, "post_host",
+                       *self._post_host_args(hook, hostname, return_code, timestamp, metrics))
+        for runner in self._runners:
+            runner.put("post_host",
+                       self._post_host_args(runner.hook, hostname, return_code, timestamp, metrics))
+
+    def skip_host(self, hostname, reason):
+        for hook in self._sync_hooks:
+            self._call(hook, "skip_host", hostname, reason)
+        for runner in self._runners:
+            runner.put("skip_host", (hostname, reason))
+
+    def post_job(self, timestamp):
+        """ Run post_job for every hook and wait for asynchronous hooks to
+            finish handling their queued events.
+        """
+        for hook in self._sync_hooks:
+            self._call(hook, "post_job", timestamp)
+        for runner in self._runners:
+            runner.put("post_job", (timestamp,))
+        self.close()
+
+    def close(self):
+        """ Wait for asynchronous hooks to finish handling queued events."""
+        for runner in self._runners:
+            runner.close()
+
+    def stats(self):
+        """ Returns queue counters for each asynchronous hook, by hook class name."""
+        return dict((type(runner.hook).__name__, runner.stats()) for runner in self._runners)
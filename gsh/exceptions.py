@@ -10,5 +10,8 @@ class ConfigError(Error):
 class LoaderError(Error):
     """ Error loading hosts from loader plugin."""
 
+class JournalError(Error):
+    """ Error reading or writing a job journal."""
+
 class EarlyExit(Error):
     """ Used to bail out of hooks during the pre_job stage."""
@@ -0,0 +1,145 @@
+""" Limits on how many hosts a Gsh job runs at once."""
+
+import resource
+
+import gevent.event
+
+
+# Rough number of file descriptors held open for each running host (pipes
+# for stdout/stderr, sockets) and how many to leave free for everything else.
+FDS_PER_HOST = 4
+RESERVED_FDS = 64
+RESERVED_PROCS = 64
+
+
+def system_ceiling():
+    """ Returns the most hosts that can run at once without exhausting the
+        process' file descriptor or process limits, or None if unlimited.
+    """
+    ceilings = []
+
+    nofile = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if nofile != resource.RLIM_INFINITY:
+        ceilings.append((nofile - RESERVED_FDS) // FDS_PER_HOST)
+
+    nproc = resource.getrlimit(resource.RLIMIT_NPROC)[0]
+    if nproc != resource.RLIM_INFINITY:
+        ceilings.append(nproc - RESERVED_PROCS)
+
+    if not ceilings:
+        return None
+    return max(min(ceilings), 1)
+
+
+class ForkLimit(object):
+    """ A fixed limit on the number of hosts running at once.
+
+    Attributes:
+        limit: The number of hosts allowed to run at once.
+        active: The number of hosts currently running.
+    """
+
+    def __init__(self, limit):
+        self.limit = max(limit, 1)
+        self.active = 0
+        self._released = gevent.event.Event()
+
+    def acquire(self):
+        """ Wait until there is room to start another host."""
+        while self.active >= int(self.limit):
+            self._released.clear()
+            self._released.wait()
+        self.active += 1
+
+    def release(self, remote):
+        """ Called with a RemotePopen once it has finished running."""
+        self.active -= 1
+        self._released.set()
+
+    def cancel(self):
+        """ Give back room acquired for a host which was never started."""
+        self.active -= 1
+        self._released.set()
+
+
+class AdaptiveForkLimit(ForkLimit):
+    """ A limit which adapts to how well hosts are completing.
+
+    The limit starts at `initial` and grows by roughly one host for every
+    limit's worth of healthy completions. When hosts fail to connect (ssh
+    exits 255), are killed (timeouts) or start taking much longer than the
+    best seen so far, the limit is cut by `backoff`, at most once per
+    window. The limit never exceeds what the process' file descriptor and
+    process rlimits allow.
+
+    Attributes:
+        minimum: The limit will never drop below this.
+        maximum: The limit will never grow beyond this.
+        backoff: Multiplier applied to the limit on congestion.
+        latency_factor: How many times slower than the best observed host
+            duration hosts may get before it's treated as congestion.
+        latency_slack: Seconds hosts may slow down by regardless of
+            latency_factor, so jitter on very quick commands is ignored.
+    """
+
+    # Where to start when no initial limit is given.
+    DEFAULT_INITIAL = 16
+
+    def __init__(self, initial, minimum=1, maximum=None, backoff=0.5, latency_factor=3.0,
+                 latency_slack=1.0):
+        ceiling = system_ceiling()
+        if maximum is None or (ceiling is not None and ceiling < maximum):
+            maximum = ceiling
+
+        self.minimum = max(minimum, 1)
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_factor = latency_factor
+        self.latency_slack = latency_slack
+
+        super(AdaptiveForkLimit, self).__init__(self._clamp(float(initial)))
+
+        self.completed = 0
+        self._last_decrease = 0
+        self._latency = None
+        self._best_latency = None
+
+    def _clamp(self, limit):
+        if self.maximum is not None:
+            limit = min(limit, self.maximum)
+        return max(limit, self.minimum)
+
+    def _congested(self, remote):
+        if remote.rc == 255 or (remote.rc is not None and remote.rc < 0):
+            return True
+
+        if remote.start_time is None or remote.end_time is None:
+            return False
+
+        duration = remote.end_time - remote.start_time
+        if self._latency is None:
+            self._latency = duration
+        else:
+            self._latency = 0.8 * self._latency + 0.2 * duration
+
+        if self._best_latency is None or self._latency < self._best_latency:
+            self._best_latency = self._latency
+            return False
+
+        threshold = max(self._best_latency * self.latency_factor,
+                        self._best_latency + self.latency_slack)
+        return self._latency > threshold
+
+    def release(self, remote):
+        self.completed += 1
+
+        if self._congested(remote):
+            # Only back off once per window so a burst of failures from
+            # the same round of hosts doesn't collapse the limit.
+            if self.completed - self._last_decrease >= self.limit:
+                self.limit = self._clamp(self.limit * self.backoff)
+                self._last_decrease = self.completed
+        else:
+            self.limit = self._clamp(self.limit + 1.0 / self.limit)
+
+        super(AdaptiveForkLimit, self).release(remote)
@@ -0,0 +1,126 @@
+""" On-disk history of how long hosts take to run commands."""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from .cache import DEFAULT_CACHE_DIR
+
+
+class DurationHistory(object):
+    """ Remembers how long each host took to run each command.
+
+    Durations are kept as an exponentially weighted moving average, per
+    host, for each command (keyed by a fingerprint of the command with its
+    whitespace normalized) and, across all commands, in a table used when a
+    host has never run the command before. Tables are stored as JSON under
+    <cache_dir>/history and entries not updated for max_age seconds are
+    dropped when saving.
+
+    Attributes:
+        cache_dir: Directory history tables are kept in.
+        alpha: Weight given to the latest duration in the moving average.
+        max_age: Seconds after which a host's entry is forgotten.
+    """
+
+    # Name of the table of durations across all commands.
+    ALL_COMMANDS = "hosts"
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, alpha=0.3, max_age=30 * 86400):
+        self.cache_dir = os.path.join(os.path.expanduser(cache_dir), "history")
+        self.alpha = alpha
+        self.max_age = max_age
+        self._tables = {}
+        self._dirty = set()
+
+    @staticmethod
+    def fingerprint(command):
+        """ Returns the key a command's durations are stored under."""
+        normalized = " ".join(" ".join(command).split())
+        if isinstance(normalized, unicode):
+            normalized = normalized.encode("utf-8")
+        return hashlib.sha1(normalized).hexdigest()[:16]
+
+    def _table(self, name):
+        table = self._tables.get(name)
+        if table is None:
+            table = self._tables[name] = self._read(os.path.join(self.cache_dir, name))
+        return table
+
+    def expected(self, command, hostname):
+        """ Returns how long hostname is expected to take to run command, or
+            None if it's never been seen.
+        """
+        for name in (self.fingerprint(command), self.ALL_COMMANDS):
+            entry = self._table(name).get(hostname)
+            if entry is not None:
+                return entry[0]
+        return None
+
+    def record(self, command, hostname, seconds):
+        """ Fold a duration into hostname's history for command."""
+        now = time.time()
+        for name in (self.fingerprint(command), self.ALL_COMMANDS):
+            table = self._table(name)
+            entry = table.get(hostname)
+            if entry is None:
+                average = seconds
+            else:
+                average = self.alpha * seconds + (1 - self.alpha) * entry[0]
+            table[hostname] = [average, now]
+            self._dirty.add(name)
+
+    def order(self, command, hosts):
+        """ Order hosts longest expected duration first (LPT scheduling).
+
+            Hosts without any history come first, in the order given: any
+            of them could be slow and hosts known to be quick are the best
+            at filling in the tail of the job.
+
+            Returns:
+                A list of hosts.
+        """
+        unknown = []
+        known = []
+        for host in hosts:
+            duration = self.expected(command, host)
+            if duration is None:
+                unknown.append(host)
+            else:
+                known.append((duration, host))
+        known.sort(key=lambda entry: -entry[0])
+        return unknown + [host for _, host in known]
+
+    def save(self):
+        """ Write out the tables updated since they were loaded."""
+        cutoff = time.time() - self.max_age
+        for name in self._dirty:
+            table = self._tables[name]
+            for host in [host for host, entry in table.iteritems() if entry[1] < cutoff]:
+                del table[host]
+            self._write(os.path.join(self.cache_dir, name), table)
+        self._dirty = set()
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as history_file:
+                table = json.load(history_file)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(table, dict):
+            return {}
+        return dict((host.encode("utf-8"), entry) for host, entry in table.iteritems())
+
+    def _write(self, path, table):
+        # History is only used to order hosts so failing to write it is fine.
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, 0700)
+            with tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False) as history_file:
+                json.dump(table, history_file)
+            os.rename(history_file.name, path)
+        except (IOError, OSError):
+            pass
@@ -0,0 +1,69 @@
+""" Helpers for writing lists of hosts compactly."""
+
+import collections
+import re
+
+
+_NUMBERED = re.compile(r"^(.*?)(\d+)(\D*)$")
+
+
+def _ranges(numbers):
+    """ Yields (first, last) for each run of consecutive numbers."""
+    first = last = None
+    for number in numbers:
+        if first is None:
+            first = last = number
+        elif number == last + 1:
+            last = number
+        else:
+            yield first, last
+            first = last = number
+    if first is not None:
+        yield first, last
+
+
+def compress(hosts):
+    """ Collapse hosts into ranges, e.g. web01..web05 into web[01-05].
+
+        Hosts are grouped on everything but their last run of digits, and
+        zero padding is kept, so web01 and web1 are never merged.
+
+        Args:
+            hosts: An iterable of hostnames.
+
+        Returns:
+            A sorted list of host ranges.
+    """
+    numbered = collections.defaultdict(list)
+    plain = set()
+
+    for host in hosts:
+        match = _NUMBERED.match(host)
+        if match is None:
+            plain.add(host)
+            continue
+        prefix, digits, suffix = match.groups()
+        numbered[(prefix, suffix)].append(digits)
+
+    # Numbers the same length as a zero padded one share its padding.
+    groups = collections.defaultdict(set)
+    for (prefix, suffix), digit_list in numbered.iteritems():
+        padded = set(len(digits) for digits in digit_list if len(digits) > 1 and digits[0] == "0")
+        for digits in digit_list:
+            width = len(digits) if len(digits) in padded else 0
+            groups[(prefix, suffix, width)].add(int(digits))
+
+    ranges = list(plain)
+    for (prefix, suffix, width), numbers in groups.iteritems():
+        parts = []
+        for first, last in _ranges(sorted(numbers)):
+            if first == last:
+                parts.append("%0*d" % (width, first))
+            else:
+                parts.append("%0*d-%0*d" % (width, first, width, last))
+        if len(numbers) == 1:
+            ranges.append("%s%s%s" % (prefix, parts[0], suffix))
+        else:
+            ranges.append("%s[%s]%s" % (prefix, ",".join(parts), suffix))
+
+    return sorted(ranges)
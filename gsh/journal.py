@@ -0,0 +1,149 @@
+""" An append-only journal of a job's progress, used to resume it."""
+
+import collections
+import json
+import os
+import time
+
+from .exceptions import JournalError
+
+
+JournalState = collections.namedtuple("JournalState", ["command", "hosts", "results"])
+
+
+class Journal(object):
+    """ Records when each host of a job starts and finishes.
+
+    The journal is a file of JSON records, one per line, which is only
+    ever appended to: a "job" record with the command (and the hosts, when
+    they're known up front), then a "start" and a "finish" record, with the
+    return code, for each host. Resuming a job appends a "resume" record
+    and carries on in the same file. Records are flushed as they're written
+    and the file is fsync()ed at most every sync_interval seconds, so at
+    worst the last moments of an interrupted job are lost and those hosts
+    are run again. A torn final line is ignored.
+
+    Attributes:
+        path: The journal file.
+        sync_interval: Most seconds between fsync()s of the journal.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, sync_interval=1.0):
+        self.path = os.path.expanduser(path)
+        self.sync_interval = sync_interval
+        self._file = None
+        self._last_sync = 0
+
+    def load(self):
+        """ Read back what the journal has recorded.
+
+            Returns:
+                A JournalState of the job's command, its hosts (None if they
+                weren't recorded) and a dict of host to its last return
+                code, None for hosts that started but never finished.
+
+            Raises:
+                JournalError: The journal doesn't exist or isn't a journal.
+        """
+        command = hosts = None
+        results = {}
+        try:
+            with open(self.path) as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if not isinstance(record, dict):
+                        continue
+                    event = record.get("event")
+                    if event == "job" and command is None:
+                        command = [_encode(arg) for arg in record.get("command", [])]
+                        if record.get("hosts") is not None:
+                            hosts = [_encode(host) for host in record["hosts"]]
+                    elif event == "start":
+                        results[_encode(record["host"])] = None
+                    elif event == "finish":
+                        results[_encode(record["host"])] = record.get("rc")
+        except IOError as err:
+            raise JournalError("Unable to read journal %s: %s" % (self.path, err.strerror))
+
+        if command is None:
+            raise JournalError("%s is not a gsh journal." % self.path)
+        return JournalState(command, hosts, results)
+
+    def succeeded(self, command):
+        """ Returns the hosts which succeeded when the journal's job ran.
+
+            Raises:
+                JournalError: The journal is for a different command.
+        """
+        state = self.load()
+        if state.command != list(command):
+            raise JournalError("%s is a journal of a different command: %s" % (
+                self.path, " ".join(state.command)))
+        return set(host for host, rc in state.results.iteritems() if rc == 0)
+
+    def begin(self, command, hosts=None, resume=False):
+        """ Open the journal for writing.
+
+            Raises:
+                JournalError: The journal already has a job in it and we
+                    aren't resuming it.
+        """
+        if not resume and os.path.exists(self.path) and os.path.getsize(self.path):
+            raise JournalError("Journal %s already exists, resume it or choose another." % self.path)
+
+        try:
+            self._file = open(self.path, "a")
+        except IOError as err:
+            raise JournalError("Unable to open journal %s: %s" % (self.path, err.strerror))
+
+        if resume:
+            self._write({"event": "resume"})
+        else:
+            self._write({
+                "event": "job",
+                "version": self.VERSION,
+                "command": list(command),
+                "hosts": sorted(hosts) if hosts is not None else None,
+            })
+        self.sync()
+
+    def started(self, hostname):
+        self._write({"event": "start", "host": hostname})
+
+    def finished(self, hostname, return_code):
+        self._write({"event": "finish", "host": hostname, "rc": return_code})
+
+    def _write(self, record):
+        if self._file is None:
+            return
+        record["time"] = time.time()
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        if record["time"] - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """ Make sure everything written so far is on disk."""
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_sync = time.time()
+
+    def close(self):
+        if self._file is None:
+            return
+        self.sync()
+        self._file.close()
+        self._file = None
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
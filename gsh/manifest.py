@@ -0,0 +1,214 @@
+""" A cached manifest of available plugins so they're imported only when used."""
+
+import glob
+import hashlib
+import imp
+import json
+import logging
+import os
+import tempfile
+
+import annex
+
+from .cache import DEFAULT_CACHE_DIR
+from .version import __version__
+
+
+logger = logging.getLogger("gsh")
+
+
+def _flatten(plugin_dirs):
+    dirs = set()
+    for plugin_dir in plugin_dirs:
+        if isinstance(plugin_dir, basestring):
+            dirs.add(plugin_dir)
+        else:
+            dirs.update(plugin_dir)
+    return sorted(dirs)
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    return value
+
+
+class PluginStub(object):
+    """ Stands in for a plugin which hasn't been imported yet.
+
+    Stubs carry the plugin's class name as __name__ along with the public
+    class attributes of its base plugin (opt_short, show_cli, etc) as they
+    were when the manifest was built, which is all that's needed to build
+    the command line.
+    """
+
+    def __init__(self, plugins, name, path, attrs):
+        self.__name__ = name
+        self.path = path
+        self._plugins = plugins
+        for attr, value in attrs.iteritems():
+            setattr(self, attr, _encode(value))
+
+    def load(self):
+        """ Import and return the real plugin."""
+        return getattr(self._plugins, self.__name__)
+
+    def __repr__(self):
+        return "<PluginStub %s from %s>" % (self.__name__, self.path)
+
+
+class LazyPlugins(object):
+    """ An annex.Annex lookalike backed by a plugin manifest.
+
+    Iterating gives a PluginStub for each plugin while looking a plugin up
+    by class name imports its module and returns the plugin itself,
+    instantiated if requested, just as Annex would.
+    """
+
+    def __init__(self, entries, instantiate=True, loaded=None):
+        self._instantiate = instantiate
+        self._loaded = dict(loaded or {})
+        self._modules = {}
+        self._stubs = [
+            PluginStub(self, _encode(entry["name"]), _encode(entry["path"]), entry["attrs"])
+            for entry in entries
+        ]
+
+    def __len__(self):
+        return len(self._stubs)
+
+    def __iter__(self):
+        return iter(self._stubs)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name in self._loaded:
+            return self._loaded[name]
+        for stub in self._stubs:
+            if stub.__name__ == name:
+                return self._load(stub)
+        raise AttributeError(name)
+
+    def _load(self, stub):
+        module = self._modules.get(stub.path)
+        if module is None:
+            module_path, module_file = os.path.split(stub.path)
+            module_file = os.path.splitext(module_file)[0]
+            # Use the same module names as annex so plugins behave the same
+            # whichever way they were loaded.
+            found = imp.find_module(module_file, [module_path])
+            try:
+                module = imp.load_module("annex_plugin_%s" % module_file, *found)
+            finally:
+                if found[0]:
+                    found[0].close()
+            self._modules[stub.path] = module
+
+        plugin = getattr(module, stub.__name__)
+        if self._instantiate:
+            plugin = plugin()
+        self._loaded[stub.__name__] = plugin
+        return plugin
+
+
+class PluginManifest(object):
+    """ Builds and caches the manifest of plugins in a set of directories.
+
+    The first time a set of plugin directories is seen every plugin in them
+    is imported, through annex, to record its name and attributes in
+    <cache_dir>/plugins. After that only the directories and plugin files
+    are stat()ed and plugins are imported as they're looked up. The manifest
+    is rebuilt whenever a directory or plugin file's mtime or size changes,
+    or gsh itself is upgraded.
+
+    Attributes:
+        cache_dir: Directory manifests are kept in.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = os.path.join(os.path.expanduser(cache_dir), "plugins")
+
+    def plugins(self, kind, base_plugin, plugin_dirs, instantiate=True):
+        """ Returns a LazyPlugins for the base_plugin subclasses in plugin_dirs."""
+        plugin_dirs = _flatten(plugin_dirs)
+        stamps = self._stamps(plugin_dirs)
+        key = hashlib.sha1(json.dumps(plugin_dirs)).hexdigest()
+        path = os.path.join(self.cache_dir, "%s-%s.json" % (kind, key))
+
+        manifest = self._read(path)
+        if (manifest is not None and manifest.get("version") == __version__ and
+                manifest.get("dirs") == plugin_dirs and manifest.get("stamps") == stamps):
+            return LazyPlugins(manifest["plugins"], instantiate)
+
+        plugins = annex.Annex(base_plugin, plugin_dirs, instantiate=instantiate)
+        entries, loaded = self._describe(base_plugin, plugins)
+        self._write(path, {
+            "version": __version__,
+            "dirs": plugin_dirs,
+            "stamps": stamps,
+            "plugins": entries,
+        })
+        return LazyPlugins(entries, instantiate, loaded)
+
+    @staticmethod
+    def _describe(base_plugin, plugins):
+        attrs = [
+            attr for attr in dir(base_plugin)
+            if not attr.startswith("_") and not callable(getattr(base_plugin, attr))
+        ]
+
+        entries = []
+        loaded = {}
+        for plugin_file, module in sorted(plugins.loaded_modules.iteritems()):
+            for plugin in module.plugins:
+                cls = plugin if isinstance(plugin, type) else type(plugin)
+                values = {}
+                for attr in attrs:
+                    value = getattr(plugin, attr, None)
+                    try:
+                        json.dumps(value)
+                    except (TypeError, ValueError):
+                        continue
+                    values[attr] = value
+                entries.append({"name": cls.__name__, "path": plugin_file, "attrs": values})
+                loaded.setdefault(cls.__name__, plugin)
+        return entries, loaded
+
+    @staticmethod
+    def _stamps(plugin_dirs):
+        stamps = {}
+        for plugin_dir in plugin_dirs:
+            paths = [plugin_dir] + glob.glob(os.path.abspath(os.path.join(plugin_dir, "*.py")))
+            for path in paths:
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    stamps[path] = None
+                    continue
+                stamps[path] = [info.st_mtime, info.st_size]
+        return stamps
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (IOError, ValueError):
+            return None
+        if not isinstance(manifest, dict) or "plugins" not in manifest:
+            return None
+        return manifest
+
+    def _write(self, path, manifest):
+        # The manifest is only an optimization so failing to write it is fine.
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir, 0700)
+            with tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False) as manifest_file:
+                json.dump(manifest, manifest_file)
+            os.rename(manifest_file.name, path)
+        except (IOError, OSError):
+            logger.debug("Unable to write plugin manifest %s", path)
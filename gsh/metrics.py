@@ -0,0 +1,95 @@
+""" Per-host timing and output metrics."""
+
+import math
+import time
+
+
+def percentile(values, pct):
+    """ Returns the pct'th percentile of values using the nearest rank.
+
+        Args:
+            values: A sorted list of numbers.
+            pct: The percentile wanted, from 0 to 100.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class HostMetrics(object):
+    """ Timing breakdown and output counters for one host.
+
+    Events are marked with a timestamp as a host progresses. RemotePopen
+    marks "started" just before the executor runs, "first_byte" when the
+    first line of output arrives and "finished" once the executor returns.
+    Executors mark what they can see of the rest: "spawned" once the
+    process (or worker) running the command has started and "connected"
+    once a connection is established. Each event keeps its first mark.
+
+    Attributes:
+        hostname: The host these metrics are for.
+        marks: A dict of event to timestamp.
+        stdout_bytes, stdout_lines, stderr_bytes, stderr_lines: Counters of
+            the output seen.
+    """
+
+    # Phase name, the event it starts at and the event it ends at.
+    PHASES = (
+        ("spawn", "started", "spawned"),
+        ("connect", "started", "connected"),
+        ("first_byte", "started", "first_byte"),
+        ("runtime", "started", "finished"),
+    )
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.marks = {}
+        self.stdout_bytes = 0
+        self.stdout_lines = 0
+        self.stderr_bytes = 0
+        self.stderr_lines = 0
+
+    def mark(self, event, timestamp=None):
+        """ Record when event happened, now unless timestamp is given."""
+        if event not in self.marks:
+            self.marks[event] = time.time() if timestamp is None else timestamp
+
+    def count(self, stream, line):
+        """ Count a line of output on stream."""
+        if stream == "stderr":
+            self.stderr_bytes += len(line)
+            self.stderr_lines += 1
+        else:
+            self.stdout_bytes += len(line)
+            self.stdout_lines += 1
+
+    def count_chunk(self, stream, data):
+        """ Count a chunk of output, which may hold several lines, on stream."""
+        lines = data.count("\n")
+        if stream == "stderr":
+            self.stderr_bytes += len(data)
+            self.stderr_lines += lines
+        else:
+            self.stdout_bytes += len(data)
+            self.stdout_lines += lines
+
+    def durations(self):
+        """ Returns a dict of phase to seconds, or None if it wasn't seen."""
+        durations = {}
+        for phase, start, end in self.PHASES:
+            if start in self.marks and end in self.marks:
+                durations[phase] = max(self.marks[end] - self.marks[start], 0.0)
+            else:
+                durations[phase] = None
+        return durations
+
+    def as_dict(self):
+        return {
+            "hostname": self.hostname,
+            "durations": self.durations(),
+            "stdout_bytes": self.stdout_bytes,
+            "stdout_lines": self.stdout_lines,
+            "stderr_bytes": self.stderr_bytes,
+            "stderr_lines": self.stderr_lines,
+        }
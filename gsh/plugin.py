@@ -5,7 +5,13 @@ Module for declaring plugin base classes and helpers.
 #pylint: disable=R0921,C0301
 
 import annex
+import gevent
 import os
+from gevent.threadpool import ThreadPool
+
+from .exceptions import LoaderError
+from .manifest import DEFAULT_CACHE_DIR, PluginManifest
+from .metrics import HostMetrics
 
 BUILTIN_PLUGIN_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "plugins")
 
@@ -23,6 +29,31 @@ class BaseHostLoader(object):
     opt_help = None
     opt_nargs = None
 
+    # Seconds the hosts returned by this loader may be cached for. Useful
+    # for loaders backed by something slow like an inventory service.
+    cache_ttl = None
+
+    # Loaders are run concurrently with each other. Set blocking if your
+    # loader makes blocking calls (sockets, subprocesses, etc) so it's run
+    # on a thread rather than a greenlet. timeout is how many seconds the
+    # loader is allowed before giving up on it.
+    blocking = False
+    timeout = None
+
+    def cache_dependencies(self, *args):
+        """ Files the hosts returned for args are read from.
+
+            File based loaders can override this so their results are cached
+            until one of the files changes.
+
+            Args:
+                args: The same arguments passed when calling the loader.
+
+            Returns:
+                A list of file paths, or None if the loader isn't file based.
+        """
+        return None
+
     def __call__(self, *args):
         """ Method called to retreive a list of hosts.
 
@@ -45,6 +76,21 @@ class BaseExecutionHook(object):
 
     show_cli = True
 
+    # Asynchronous hooks receive their events, in order, through a bounded
+    # queue handled on a greenlet of their own, so a hook which blocks (on
+    # a socket or disk for instance) doesn't hold up running hosts. When the
+    # queue is full output is handled per overflow: "block" waits for room,
+    # "drop" discards it and "sample" lets one in every sample_rate batches
+    # through once the queue is half full. Other events always wait.
+    asynchronous = False
+    queue_size = 1024
+    overflow = "block"
+    sample_rate = 10
+
+    # Hooks setting wants_metrics are passed the host's gsh.metrics.HostMetrics
+    # as a fourth argument to post_host.
+    wants_metrics = False
+
     def pre_job(self, command, hosts, timestamp):
         """ Called first before any commands are executed.
 
@@ -71,13 +117,39 @@ class BaseExecutionHook(object):
                 line: The line of output streamed from the host.
         """
 
-    def post_host(self, hostname, return_code, timestamp):
+    def update_host_batch(self, hostname, lines):
+        """ Called with several lines of output from a host at once.
+
+            Override this instead of update_host to receive output in
+            batches, which amortizes the per-line cost of very chatty
+            commands. Lines are coalesced per host and delivered when a
+            batch fills up, after a short flush window, or before post_host.
+
+            Args:
+                hostname: The host where the output has come from.
+                lines: A list of (stream, line) tuples in the order streamed.
+        """
+        for stream, line in lines:
+            self.update_host(hostname, stream, line)
+
+    def post_host(self, hostname, return_code, timestamp, metrics=None):
         """ Called for each host, after a host has finished executing a command.
 
             Args:
                 hostname: The host we're about to run a command on.
                 return_code: The exitcode received from the remote command.
                 timestamp: A Unix timestamp when this hook was run.
+                metrics: Only passed when wants_metrics is set. The host's
+                    HostMetrics, its timing breakdown and output counters.
+        """
+
+    def skip_host(self, hostname, reason):
+        """ Called for each host never run because the job was stopped early,
+            by a RunPolicy for instance.
+
+            Args:
+                hostname: The host that was skipped.
+                reason: Why the job stopped.
         """
 
     def post_job(self, timestamp):
@@ -88,6 +160,17 @@ class BaseExecutionHook(object):
         """
 
 
+def overrides(hook, method):
+    """ Whether a hook provides its own implementation of a hook method.
+
+        Used to skip calling methods that would only fall through to the
+        no-op implementations on BaseExecutionHook.
+    """
+    base = getattr(BaseExecutionHook, method).__func__
+    func = getattr(getattr(type(hook), method, None), "__func__", None)
+    return func is not base
+
+
 class BaseExecutor(object):
     """ Base Executor to be instantiated at the job level.
 
@@ -106,6 +189,13 @@ class BaseExecutor(object):
         self.args = [] if args is None else args
         self.kwargs = {} if kwargs is None else kwargs
 
+    def close(self):
+        """ Called once the executor is no longer needed.
+
+            Override this to release anything held across hosts, such as
+            cached connections.
+        """
+
 
 class BaseInnerExecutor(object):
     """ Executor to be instantiated per host.
@@ -116,6 +206,8 @@ class BaseInnerExecutor(object):
         command: The command to run on the host.
         timeout: Max time before failure.
         update: A callback to write the output from the command.
+        metrics: The host's HostMetrics. Mark "spawned" and "connected" on it
+            when you can tell they've happened.
 
     """
 
@@ -125,6 +217,7 @@ class BaseInnerExecutor(object):
         self.command = command
         self.timeout = timeout
         self.update = update
+        self.metrics = HostMetrics(hostname)
 
     def run(self):
         """ The actual execution logic goes here.
@@ -134,35 +227,118 @@ class BaseInnerExecutor(object):
         """
         return 0
 
+    def cancel(self):
+        """ Called, from another greenlet, to stop a command while it runs.
+
+            Override this to kill whatever is running the command so run()
+            returns promptly. Executors which can't be interrupted leave
+            the command to finish on its own.
+        """
+
+
+def run_loaders(loaders, cache=None, timeout=None):
+    """ Resolve hosts from several loaders at once.
+
+        Args:
+            loaders: A dict of loader to the list of arguments to call it with.
+            cache: An optional gsh.cache.HostCache to resolve hosts through.
+            timeout: Seconds to allow each loader which doesn't set its own.
+
+        Returns:
+            A set of all of the hosts returned.
 
-def get_loaders(additional_dirs=None):
-    """ Helper function to find and load all loaders. """
+        Raises:
+            LoaderError: One or more of the loaders failed or timed out.
+    """
+    def _load(loader, args):
+        if cache is not None:
+            return cache.load(loader, args)
+        return loader(*args)
+
+    def _load_on_thread(loader, args):
+        # gevent's pool prints anything raised on its threads, so errors are
+        # handed back to be raised (and reported) from the greenlet instead.
+        try:
+            return _load(loader, args), None
+        except Exception as err:
+            return None, err
+
+    def _run(loader, args):
+        # Errors are returned rather than raised so they're all reported
+        # together, once every loader has finished.
+        loader_timeout = loader.timeout if loader.timeout is not None else timeout
+        try:
+            with gevent.Timeout(loader_timeout):
+                if loader.blocking:
+                    loaded, err = threads.apply(_load_on_thread, (loader, args))
+                    if err is not None:
+                        raise err
+                    return loaded, None
+                return _load(loader, args), None
+        except gevent.Timeout:
+            return None, "%s timed out after %s second(s)." % (
+                type(loader).__name__, loader_timeout)
+        except LoaderError as err:
+            return None, str(err)
+        except Exception as err:
+            return None, "%s failed: %s" % (type(loader).__name__, err)
+
+    threads = None
+    blocking = len([loader for loader in loaders if loader.blocking])
+    if blocking:
+        threads = ThreadPool(blocking)
+    greenlets = [gevent.spawn(_run, loader, args) for loader, args in loaders.iteritems()]
+    gevent.joinall(greenlets)
+    if threads is not None:
+        # Don't leave idle threads behind. A loader still running past its
+        # timeout finishes on its own.
+        threads.kill()
+
+    hosts = set()
+    errors = []
+    for greenlet in greenlets:
+        loaded, error = greenlet.value
+        if error is not None:
+            errors.append(error)
+        else:
+            hosts.update(loaded)
+
+    if errors:
+        raise LoaderError(" ".join(errors))
+    return hosts
+
+
+def _plugin_dirs(kind, additional_dirs):
     if additional_dirs is None:
         additional_dirs = []
-    return annex.Annex(BaseHostLoader, [
-        os.path.join(BUILTIN_PLUGIN_DIR, "loaders"),
-        "/etc/gsh/plugins/loaders",
-        [os.path.expanduser(os.path.join(plugin_dir, "loaders")) for plugin_dir in additional_dirs]
-    ])
+    return [
+        os.path.join(BUILTIN_PLUGIN_DIR, kind),
+        "/etc/gsh/plugins/%s" % kind,
+        [os.path.expanduser(os.path.join(plugin_dir, kind)) for plugin_dir in additional_dirs]
+    ]
+
+
+def _get_plugins(kind, base_plugin, additional_dirs, instantiate, lazy, cache_dir):
+    plugin_dirs = _plugin_dirs(kind, additional_dirs)
+    if lazy:
+        return PluginManifest(cache_dir).plugins(kind, base_plugin, plugin_dirs, instantiate)
+    return annex.Annex(base_plugin, plugin_dirs, instantiate=instantiate)
 
 
-def get_hooks(additional_dirs=None):
+def get_loaders(additional_dirs=None, lazy=False, cache_dir=DEFAULT_CACHE_DIR):
+    """ Helper function to find and load all loaders.
+
+        With lazy, plugins are described by a cached manifest and only
+        imported when looked up by name. See gsh.manifest.
+    """
+    return _get_plugins("loaders", BaseHostLoader, additional_dirs, True, lazy, cache_dir)
+
+
+def get_hooks(additional_dirs=None, lazy=False, cache_dir=DEFAULT_CACHE_DIR):
     """ Helper function to find and load all hooks. """
-    if additional_dirs is None:
-        additional_dirs = []
-    return annex.Annex(BaseExecutionHook, [
-        os.path.join(BUILTIN_PLUGIN_DIR, "hooks"),
-        "/etc/gsh/plugins/hooks",
-        [os.path.expanduser(os.path.join(plugin_dir, "hooks")) for plugin_dir in additional_dirs]
-    ], instantiate=False)
+    return _get_plugins("hooks", BaseExecutionHook, additional_dirs, False, lazy, cache_dir)
 
 
-def get_executors(additional_dirs=None):
+def get_executors(additional_dirs=None, lazy=False, cache_dir=DEFAULT_CACHE_DIR):
     """ Helper function to find and load all executors. """
-    if additional_dirs is None:
-        additional_dirs = []
-    return annex.Annex(BaseExecutor, [
-        os.path.join(BUILTIN_PLUGIN_DIR, "executors"),
-        "/etc/gsh/plugins/executors",
-        [os.path.expanduser(os.path.join(plugin_dir, "executors")) for plugin_dir in additional_dirs]
-    ], instantiate=False)
+    return _get_plugins("executors", BaseExecutor, additional_dirs, False, lazy, cache_dir)
@@ -0,0 +1,120 @@
+import os
+import random
+
+import gevent
+from gevent.event import Event
+from gevent_subprocess import Popen, PIPE
+
+from gsh.plugin import BaseExecutor, BaseInnerExecutor
+
+
+class LocalExecutor(BaseExecutor):
+    """ Runs commands on the local machine instead of a remote host.
+
+    Mostly useful for benchmarking and testing gsh itself without a fleet of
+    machines to ssh to. In "subprocess" mode (the default) each host's
+    command is run with sh -c and GSH_HOST set to the hostname. In
+    "synthetic" mode no process is run at all; each host waits for latency
+    seconds (plus up to jitter more) and emits lines lines of line_size
+    bytes, then fails with failure_rc for a failure_rate fraction of hosts.
+
+    e.g. gsh -e local:mode=synthetic,latency=0.2,lines=1000 -f hosts
+    """
+
+    def __init__(self, args, kwargs):
+        self.mode = kwargs.get("mode", args[0] if args else "subprocess")
+        if self.mode not in ("subprocess", "synthetic"):
+            raise ValueError("Unknown LocalExecutor mode: %s" % self.mode)
+
+        self.latency = float(kwargs.get("latency", 0))
+        self.jitter = float(kwargs.get("jitter", 0))
+        self.lines = int(kwargs.get("lines", 0))
+        self.line_size = max(int(kwargs.get("line_size", 80)), 1)
+        self.stderr_lines = int(kwargs.get("stderr_lines", 0))
+        self.failure_rate = float(kwargs.get("failure_rate", 0))
+        self.failure_rc = int(kwargs.get("failure_rc", 1))
+        # Lines are emitted in bursts of this many, yielding between them
+        # as output read from a pipe would.
+        self.burst = max(int(kwargs.get("burst", 64)), 1)
+
+        seed = kwargs.get("seed")
+        self.random = random.Random(None if seed is None else int(seed))
+
+        super(LocalExecutor, self).__init__(args, kwargs)
+
+    class Executor(BaseInnerExecutor):
+        def __init__(self, *args, **kwargs):
+            super(LocalExecutor.Executor, self).__init__(*args, **kwargs)
+            self._proc = None
+            self._readers = []
+            self._cancelled = Event()
+
+        def run(self):
+            if self.parent.mode == "synthetic":
+                return self._run_synthetic()
+            return self._run_subprocess()
+
+        def _timed_out(self):
+            self.update(self.hostname, "stderr",
+                        "GSH: command timed out after %s second(s).\n" % self.timeout)
+            return -9
+
+        def _emit(self, stream, count):
+            prefix = "%s %s " % (self.hostname, stream)
+            padding = "x" * max(self.parent.line_size - len(prefix) - 8, 0)
+            for num in xrange(count):
+                self.update(self.hostname, stream, "%s%s%07d\n" % (prefix, padding, num))
+                if (num + 1) % self.parent.burst == 0:
+                    gevent.sleep(0)
+
+        def _run_synthetic(self):
+            parent = self.parent
+            self.metrics.mark("spawned")
+            latency = parent.latency + parent.random.random() * parent.jitter
+            failed = parent.random.random() < parent.failure_rate
+
+            if self.timeout is not None and latency > self.timeout:
+                if self._cancelled.wait(self.timeout):
+                    return -9
+                return self._timed_out()
+
+            if self._cancelled.wait(latency):
+                return -9
+            self._emit("stdout", parent.lines)
+            self._emit("stderr", parent.stderr_lines)
+
+            if failed:
+                return parent.failure_rc
+            return 0
+
+        def _stream(self, fd, stream):
+            for line in iter(fd.readline, b""):
+                self.update(self.hostname, stream, line)
+
+        def _run_subprocess(self):
+            env = dict(os.environ, GSH_HOST=self.hostname)
+            proc = self._proc = Popen(["sh", "-c", " ".join(self.command)],
+                         stdout=PIPE, stderr=PIPE, env=env)
+            self.metrics.mark("spawned")
+
+            readers = self._readers = [
+                gevent.spawn(self._stream, proc.stdout, "stdout"),
+                gevent.spawn(self._stream, proc.stderr, "stderr"),
+            ]
+            waiter = gevent.spawn(proc.wait)
+            gevent.joinall(readers + [waiter], timeout=self.timeout)
+
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+                gevent.killall(readers)
+                return self._timed_out()
+
+            return proc.wait()
+
+        def cancel(self):
+            self._cancelled.set()
+            if self._proc is not None and self._proc.poll() is None:
+                self._proc.kill()
+            # Anything the command started may still hold its pipes open.
+            gevent.killall(self._readers, block=False)
@@ -1,118 +1,138 @@
-import cStringIO
+import collections
 import getpass
-import gevent
+import Queue
 import select
 import socket
-import termios
 import threading
-import tty
 import time
 
-from gsh.plugin import BaseExecutor, BaseInnerExecutor
-
-
-class _ParamikoThread(threading.Thread):
-    def __init__(self, executor):
-        self.executor = executor
-        super(_ParamikoThread, self).__init__()
-
-    def interactive(self, ssh, command):
-        stdout = cStringIO.StringIO()
-        stderr = cStringIO.StringIO()
-        chan = ssh.invoke_shell()
-
-        time.sleep(self.executor.parent.initial_sleep)
-
-        for cmd in command.split("\n"):
-            cmd = cmd.strip()
-            if not cmd:
-                continue
-            time.sleep(self.executor.parent.cmd_sleep)
-            chan.send(cmd + "\n")
+import gevent
+import gevent.event
+from gevent.threadpool import ThreadPool
 
-        while True:
-            read, write, error = select.select([chan], [], [], 5)
+from gsh.plugin import BaseExecutor, BaseInnerExecutor
+from gsh.stream import LineBuffer
 
-            if not any([read, write, error]):
-                stderr.write("GSH: Channel Timed Out!\n")
-                break
 
-            if chan in read:
-                try:
-                    out = chan.recv(1024)
-                    if not out:
-                        break
-                    stdout.write(out)
-                except socket.timeout:
-                    pass
+def _interactive(executor, ssh, command):
+    chan = ssh.invoke_shell()
+    stdout = executor.line_buffer()
 
-        try:
-            chan.close()
-        except EOFError:
-            pass
-        stdout.seek(0)
-        stderr.seek(0)
-        return stdout, stderr
+    time.sleep(executor.parent.initial_sleep)
 
+    for cmd in command.split("\n"):
+        cmd = cmd.strip()
+        if not cmd:
+            continue
+        time.sleep(executor.parent.cmd_sleep)
+        chan.send(cmd + "\n")
 
-    def run(self):
-        # Defer import since most people won't want to use this executor
-        # and I don't want it to be required to use gsh.
-        import paramiko
+    while True:
+        read, write, error = select.select([chan], [], [], 5)
 
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        if not any([read, write, error]):
+            executor.emit("stderr", ["GSH: Channel Timed Out!"])
+            break
 
-        connect_opts = {
-            "timeout": self.executor.parent.timeout,
-        }
+        if chan in read:
+            try:
+                out = chan.recv(executor.parent.chunk_size)
+                if not out:
+                    break
+                executor.emit("stdout", stdout.feed(out))
+            except socket.timeout:
+                pass
 
-        if self.executor.parent.password:
-            connect_opts.update({
-                "username": self.executor.parent.username,
-                "password": self.executor.parent.password,
-                "look_for_keys": False,
-                "allow_agent": False,
-            })
+    executor.emit("stdout", stdout.flush())
 
-        try:
-            ssh.connect(self.executor.hostname, **connect_opts)
-        except socket.timeout, err:
-            self.executor.update(self.executor.hostname, "stderr", "GSH: Connection timeout: %s" % err)
-            self.executor.rv = 1
-            return
-        except paramiko.ssh_exception.SSHException, err:
-            self.executor.update(self.executor.hostname, "stderr", "GSH: SSHException: %s" % err)
-            self.executor.rv = 1
-            return
-        except paramiko.BadAuthenticationType, err:
-            self.executor.update(self.executor.hostname, "stderr", "GSH: Failed to login.")
-            self.executor.rv = 1
-            return
-
-
-        command = " ".join(self.executor.command)
+    try:
+        chan.close()
+    except EOFError:
+        pass
 
-        try:
-            if "interactive" in self.executor.parent.args:
-                stdout, stderr = self.interactive(ssh, command)
-                rv = 0  # Find a way to get rv later.
-            else:
-                stdin, stdout, stderr = ssh.exec_command(command)
-                rv = stdout.channel.recv_exit_status()
-        except paramiko.ssh_exception.SSHException, err:
-            self.executor.update(self.executor.hostname, "stderr", "GSH: SSHException: %s" % err)
-            self.executor.rv = 1
-            return
 
-        for line in stdout.read().splitlines():
-            self.executor.update(self.executor.hostname, "stdout", line)
+def _exec(executor, ssh, command):
+    chan = ssh.get_transport().open_session()
+    chan.exec_command(command)
 
-        for line in stderr.read().splitlines():
-            self.executor.update(self.executor.hostname, "stderr", line)
+    chunk_size = executor.parent.chunk_size
+    stdout = executor.line_buffer()
+    stderr = executor.line_buffer()
 
-        ssh.close()
-        self.executor.rv = rv
+    try:
+        while True:
+            idle = True
+            if chan.recv_ready():
+                idle = False
+                executor.emit("stdout", stdout.feed(chan.recv(chunk_size)))
+            if chan.recv_stderr_ready():
+                idle = False
+                executor.emit("stderr", stderr.feed(chan.recv_stderr(chunk_size)))
+
+            if idle:
+                # A transport that drops closes the channel without EOF
+                # ever being received, so closed ends the loop too.
+                if chan.closed or (chan.exit_status_ready() and chan.eof_received):
+                    break
+                # The channel's fileno becomes readable when either stream
+                # has data or the channel is closed.
+                select.select([chan], [], [], 1)
+
+        executor.emit("stdout", stdout.flush())
+        executor.emit("stderr", stderr.flush())
+        # paramiko reports -1 when the channel closed without an exit status.
+        rc = chan.recv_exit_status() if chan.exit_status_ready() else -1
+        if rc == -1:
+            executor.emit("stderr", ["GSH: Connection closed before the command exited."])
+            return 255
+        return rc
+    finally:
+        chan.close()
+
+
+def _run_command(executor):
+    """ Runs the command for a single host. Called from a worker thread.
+
+        Output is handed to the executor as it arrives.
+
+        Returns:
+            The return code of the command.
+    """
+    # Defer import since most people won't want to use this executor
+    # and I don't want it to be required to use gsh.
+    import paramiko
+
+    # Marks are set from the worker thread, which is safe as each is a
+    # single dict assignment.
+    executor.metrics.mark("spawned")
+    try:
+        ssh = executor.parent.connect(executor.hostname)
+    except socket.timeout, err:
+        executor.emit("stderr", ["GSH: Connection timeout: %s" % err])
+        return 1
+    except socket.error, err:
+        executor.emit("stderr", ["GSH: Connection failed: %s" % err])
+        return 1
+    except paramiko.ssh_exception.SSHException, err:
+        executor.emit("stderr", ["GSH: SSHException: %s" % err])
+        return 1
+    except paramiko.BadAuthenticationType, err:
+        executor.emit("stderr", ["GSH: Failed to login."])
+        return 1
+    executor.metrics.mark("connected")
+
+    command = " ".join(executor.command)
+
+    try:
+        if "interactive" in executor.parent.args:
+            _interactive(executor, ssh, command)
+            return 0  # Find a way to get rv later.
+        return _exec(executor, ssh, command)
+    except paramiko.ssh_exception.SSHException, err:
+        executor.emit("stderr", ["GSH: SSHException: %s" % err])
+        return 1
+    finally:
+        executor.parent.release(executor.hostname)
 
 
 class ParamikoExecutor(BaseExecutor):
@@ -132,25 +152,151 @@ class ParamikoExecutor(BaseExecutor):
         if not self.password and "password" in args:
             self.password = getpass.getpass("Password: ")
 
+        # Paramiko only offers a blocking API so commands are run on a
+        # bounded pool of threads rather than a thread per host.
+        self.workers = ThreadPool(int(kwargs.get("workers", 32)))
+
+        # Output is streamed back in chunks of chunk_size bytes. At most
+        # buffer_chunks chunks are held per host before the worker thread
+        # waits for hooks to catch up, keeping memory flat.
+        self.chunk_size = int(kwargs.get("chunk_size", 32768))
+        self.buffer_chunks = int(kwargs.get("buffer_chunks", 16))
+        self.max_line = int(kwargs.get("max_line", 65536))
+
+        # Authenticated connections are cached per host so that several
+        # commands against the same host share a single transport. Each
+        # holds a socket and a transport thread, so only the max_clients
+        # most recently used are kept once their commands have finished.
+        self.max_clients = int(kwargs.get("max_clients", 64))
+        self._clients = collections.OrderedDict()
+        self._in_use = collections.defaultdict(int)
+        self._host_locks = {}
+        self._lock = threading.Lock()
+
+    def connect(self, hostname):
+        """ Returns a connected SSHClient for hostname, reusing live transports.
+
+            The client is kept from being evicted until release(hostname) is
+            called. This is called from worker threads.
+        """
+        with self._lock:
+            host_lock = self._host_locks.setdefault(hostname, threading.Lock())
+            self._in_use[hostname] += 1
+
+        try:
+            with host_lock:
+                return self._connect(hostname)
+        except Exception:
+            self.release(hostname)
+            raise
+
+    def _connect(self, hostname):
+        import paramiko
+
+        with self._lock:
+            ssh = self._clients.pop(hostname, None)
+        if ssh is not None:
+            transport = ssh.get_transport()
+            if transport is not None and transport.is_active():
+                with self._lock:
+                    self._clients[hostname] = ssh
+                return ssh
+            ssh.close()
+
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+        connect_opts = {
+            "timeout": self.timeout,
+        }
+
+        if self.password:
+            connect_opts.update({
+                "username": self.username,
+                "password": self.password,
+                "look_for_keys": False,
+                "allow_agent": False,
+            })
+
+        ssh.connect(hostname, **connect_opts)
+        with self._lock:
+            self._clients[hostname] = ssh
+        return ssh
+
+    def release(self, hostname):
+        """ Mark hostname's client as no longer in use, closing the least
+            recently used idle clients beyond max_clients.
+        """
+        with self._lock:
+            self._in_use[hostname] -= 1
+            if not self._in_use[hostname]:
+                del self._in_use[hostname]
+
+            evicted = []
+            excess = len(self._clients) - self.max_clients
+            for host in list(self._clients):
+                if excess <= 0:
+                    break
+                if host not in self._in_use:
+                    evicted.append(self._clients.pop(host))
+                    excess -= 1
+
+        for ssh in evicted:
+            ssh.close()
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = self._clients, collections.OrderedDict()
+        for ssh in clients.itervalues():
+            ssh.close()
 
     class Executor(BaseInnerExecutor):
         def __init__(self, *args, **kwargs):
             super(ParamikoExecutor.Executor, self).__init__(*args, **kwargs)
-            self.rv = 0
-
-        def run(self):
-
-            thread = _ParamikoThread(self)
-            thread.daemon = True
-            thread.start()
+            self._output = Queue.Queue(self.parent.buffer_chunks)
+            self._ready = gevent.event.Event()
+            # Worker threads can't touch the Event directly, they wake the
+            # hub through this watcher instead.
+            self._wakeup = gevent.get_hub().loop.async()
+            self._finished = False
+
+        def line_buffer(self):
+            return LineBuffer(self.parent.max_line, keepends=False)
+
+        def emit(self, stream, lines):
+            """ Queue lines of output for the hooks. Called from worker threads."""
+            if not lines:
+                return
+            while not self._finished:
+                try:
+                    self._output.put((stream, lines), timeout=1)
+                except Queue.Full:
+                    continue
+                self._wakeup.send()
+                return
 
-            sleep_duration = 0.01
+        def _drain(self):
             while True:
-                alive = thread.is_alive()
-                if not alive:
-                    return self.rv
-                gevent.sleep(sleep_duration)
-                if sleep_duration < 0.5:
-                    sleep_duration *= 2
-
-            return self.rv
+                try:
+                    stream, lines = self._output.get_nowait()
+                except Queue.Empty:
+                    return
+                for line in lines:
+                    self.update(self.hostname, stream, line)
+
+        def run(self):
+            self._wakeup.start(self._ready.set)
+            result = self.parent.workers.spawn(_run_command, self)
+            result.rawlink(lambda _: self._ready.set())
+
+            try:
+                while not result.ready():
+                    self._ready.wait()
+                    self._ready.clear()
+                    self._drain()
+                self._drain()
+            finally:
+                self._finished = True
+                self._wakeup.stop()
+
+            return result.get()
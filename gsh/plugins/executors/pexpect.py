@@ -19,6 +19,7 @@ class _PexpectThread(threading.Thread):
             ssh = pxssh.pxssh()
             ssh.force_password = True
             ssh.login(self.executor.hostname, self.executor.parent.username, self.executor.parent.password)
+            self.executor.metrics.mark("connected")
 
 
             command = " ".join(self.executor.command)
@@ -0,0 +1,193 @@
+import itertools
+import logging
+import math
+import pipes
+import shlex
+
+import gevent
+from gevent.event import AsyncResult
+from gevent_subprocess import Popen, PIPE
+
+from gsh.plugin import BaseExecutor, BaseInnerExecutor
+
+
+logger = logging.getLogger("gsh")
+
+
+class _Partition(object):
+    """ A group of hosts handed to a single relay run."""
+
+    def __init__(self, relay):
+        self.relay = relay
+        self.executors = {}
+        self.proc = None
+
+
+class RelayExecutor(BaseExecutor):
+    """ Fans commands out through relay nodes which run gsh themselves.
+
+    Rather than this process running every host, hosts are gathered into
+    partitions of up to fanout hosts and each partition is handed to a gsh
+    on one of the relays (positional arguments, used round robin), which
+    runs its hosts with the executor given by executor. Relays stream each
+    host's output and return code back (see RelayOutputHook) so hooks here
+    see the usual per-host events. A relay named "local" runs gsh as a
+    local subprocess, which is handy for testing.
+
+    The fork limit still caps how many hosts are in flight overall, so
+    raise it to keep several relays busy, e.g.
+
+        gsh -F 2000 -e relay:jump1,jump2,fanout=1000 -g everything uptime
+
+    Options:
+        fanout: Most hosts handed to a single relay run (default: 256).
+        gather: Seconds to wait for more hosts before starting a partition
+            which isn't full yet (default: 0.05).
+        executor: Executor the relays run hosts with (default: ssh).
+        forklimit: Fork limit on each relay (default: fanout).
+        gsh_path: Command to run gsh on a relay (default: gsh).
+        ssh_opts: Extra options for the ssh to each relay.
+    """
+
+    def __init__(self, args, kwargs):
+        self.relays = list(args) or ["local"]
+        self.fanout = max(int(kwargs.get("fanout", 256)), 1)
+        self.gather = float(kwargs.get("gather", 0.05))
+        self.remote_executor = kwargs.get("executor", "ssh")
+        self.forklimit = int(kwargs.get("forklimit", self.fanout))
+        self.gsh_path = shlex.split(kwargs.get("gsh_path", "gsh"))
+        self.ssh_opts = kwargs.get("ssh_opts", [])
+
+        self._relays = itertools.cycle(self.relays)
+        self._partition = None
+        self._gatherer = None
+        self._running = set()
+
+        super(RelayExecutor, self).__init__(args, kwargs)
+
+    def submit(self, executor):
+        """ Add a host's executor to the partition being gathered."""
+        if self._partition is None:
+            self._partition = _Partition(next(self._relays))
+            self._gatherer = gevent.spawn_later(self.gather, self._launch)
+
+        self._partition.executors[executor.hostname] = executor
+        executor.partition = self._partition
+        if len(self._partition.executors) >= self.fanout:
+            self._gatherer.kill(block=False)
+            self._launch()
+
+    def _launch(self):
+        partition, self._partition = self._partition, None
+        self._gatherer = None
+        if partition is not None and partition.executors:
+            gevent.spawn(self._run_partition, partition)
+
+    def build_command(self, relay, executor):
+        """ Builds the command line which runs gsh on relay."""
+        command = " ".join(executor.command)
+        # Keep the command from being mistaken for an option.
+        if command.startswith("-"):
+            command = " " + command
+
+        gsh = self.gsh_path + [
+            "-f", "/dev/stdin", "-N", "--hooks", "relay_output",
+            "-e", self.remote_executor, "-F", str(self.forklimit),
+        ]
+        if executor.timeout:
+            gsh.extend(["-t", str(int(math.ceil(executor.timeout)))])
+        gsh.append(command)
+
+        if relay == "local":
+            return gsh
+        return (["ssh", "-no", "PasswordAuthentication=no"] + self.ssh_opts +
+                [relay, " ".join(pipes.quote(arg) for arg in gsh)])
+
+    def _run_partition(self, partition):
+        executors = partition.executors
+        # Every host may have been cancelled before the partition started.
+        if not executors:
+            return
+        first = next(executors.itervalues())
+
+        try:
+            status = self._relay(partition, self.build_command(partition.relay, first))
+        except (OSError, IOError) as err:
+            status = err
+
+        # Anything the relay didn't report on is treated as a connection
+        # failure, just as ssh would report it.
+        for executor in executors.values():
+            executor.update(executor.hostname, "stderr",
+                            "GSH: relay %s failed before reporting: %s\n" % (partition.relay, status))
+            executor.result.set(255)
+
+    def _relay(self, partition, command):
+        """ Runs a partition on its relay. Returns the relay's exit status."""
+        proc = partition.proc = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        self._running.add(proc)
+        for executor in partition.executors.itervalues():
+            executor.metrics.mark("spawned")
+
+        try:
+            proc.stdin.write("".join("%s\n" % hostname for hostname in partition.executors))
+            proc.stdin.close()
+
+            errors = gevent.spawn(self._log_stderr, partition.relay, proc.stderr)
+            for line in iter(proc.stdout.readline, b""):
+                self._handle(partition, line)
+            errors.join()
+            return "exit status %s" % proc.wait()
+        finally:
+            self._running.discard(proc)
+            if proc.poll() is None:
+                proc.kill()
+
+    @staticmethod
+    def _log_stderr(relay, stderr):
+        for line in iter(stderr.readline, b""):
+            logger.warning("relay %s: %s", relay, line.rstrip("\n"))
+
+    @staticmethod
+    def _handle(partition, line):
+        fields = line.rstrip("\n").split("\t", 3)
+        executor = partition.executors.get(fields[1]) if len(fields) > 2 else None
+        if executor is None:
+            logger.debug("Ignoring relay output: %r", line)
+            return
+
+        if fields[0] == "O" and len(fields) == 4:
+            executor.update(executor.hostname, fields[2], fields[3].decode("string_escape"))
+        elif fields[0] == "R":
+            del partition.executors[fields[1]]
+            executor.result.set(int(fields[2]))
+
+    def cancel(self, executor):
+        """ Drop a host from its partition, killing the relay run once no
+            hosts are left for it.
+        """
+        partition = executor.partition
+        if partition.executors.pop(executor.hostname, None) is None:
+            return
+        executor.result.set(-9)
+        if not partition.executors and partition.proc is not None and partition.proc.poll() is None:
+            partition.proc.kill()
+
+    def close(self):
+        for proc in list(self._running):
+            if proc.poll() is None:
+                proc.kill()
+
+    class Executor(BaseInnerExecutor):
+        def __init__(self, *args, **kwargs):
+            super(RelayExecutor.Executor, self).__init__(*args, **kwargs)
+            self.result = AsyncResult()
+            self.partition = None
+
+        def run(self):
+            self.parent.submit(self)
+            return self.result.get()
+
+        def cancel(self):
+            if self.partition is not None:
+                self.parent.cancel(self)
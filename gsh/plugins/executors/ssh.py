@@ -1,66 +1,518 @@
+import errno
+import fcntl
+import hashlib
+import os
+import select
+import socket
+import sys
+import time
+
 import gevent
-from gevent.queue import Queue, Empty
+from gevent.event import AsyncResult
+from gevent.socket import wait_read
 from gevent_subprocess import Popen, PIPE
 
 from gsh.plugin import BaseExecutor, BaseInnerExecutor
+from gsh.stream import LineBuffer
+
+
+def _to_bool(value):
+    """ Executor kwargs arrive as strings when passed on the command line."""
+    if isinstance(value, basestring):
+        return value.strip().lower() in ("1", "y", "yes", "true", "on")
+    return bool(value)
+
+
+class _ControlMasterPool(object):
+    """ Pool of persistent, multiplexed ssh master connections.
+
+    Each host gets a ControlPath socket under a gsh-owned directory so that
+    later commands, and later runs of gsh, can reuse an already
+    authenticated session instead of paying for a full handshake. Idle
+    masters are expired by ssh itself via ControlPersist; this class picks
+    the socket for a host, health checks existing sockets, clears out stale
+    ones and caps how many masters may be open at once.
+
+    Attributes:
+        control_dir: Directory holding the master control sockets.
+        persist: Seconds a master may sit idle before ssh shuts it down.
+        max_masters: Maximum number of masters open at any time. Hosts
+            beyond this cap connect directly, without a master.
+        rescan_interval: Least seconds between rescans of the control
+            directory for expired masters once the cap has been reached.
+    """
+
+    def __init__(self, control_dir, persist, max_masters, rescan_interval=30):
+        self.control_dir = os.path.expanduser(control_dir)
+        self.persist = persist
+        self.max_masters = max_masters
+        self.rescan_interval = rescan_interval
+        self._live = None
+        self._last_prune = None
+        # Sockets handed out to ssh processes that haven't finished yet. A
+        # new master only creates its socket once it has connected.
+        self._pending = set()
+
+    def socket_path(self, hostname):
+        # Unix socket paths are limited to around 100 bytes so hostnames
+        # (which may include a user@) are hashed rather than used directly.
+        digest = hashlib.sha1(hostname).hexdigest()[:20]
+        return os.path.join(self.control_dir, "cm-%s" % digest)
+
+    @staticmethod
+    def is_alive(path):
+        """ Health check a master by connecting to its control socket.
+
+            Sockets left behind by masters that have gone away refuse
+            connections and are removed so they don't count against the cap.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except socket.error as err:
+            if err.errno == errno.ECONNREFUSED:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            return False
+        finally:
+            sock.close()
+        return True
+
+    def prune(self):
+        """ Rescan the control directory, keeping only healthy masters."""
+        if not os.path.isdir(self.control_dir):
+            os.makedirs(self.control_dir, 0700)
+
+        self._last_prune = time.time()
+        self._live = set()
+        for name in os.listdir(self.control_dir):
+            if not name.startswith("cm-"):
+                continue
+            path = os.path.join(self.control_dir, name)
+            if self.is_alive(path):
+                self._live.add(path)
+        self._live.update(self._pending)
+
+    def options(self, hostname):
+        """ Returns the ssh options to reach hostname through the pool."""
+        if self._live is None:
+            self.prune()
+
+        path = self.socket_path(hostname)
+
+        if path in self._live and path not in self._pending and not self.is_alive(path):
+            self._live.discard(path)
+
+        if path not in self._live:
+            # Masters expire on their own while we run so rescan once we
+            # believe we've hit the cap, but as a rescan health checks every
+            # master, at most once every rescan_interval seconds.
+            if (len(self._live) >= self.max_masters and
+                    time.time() - self._last_prune >= self.rescan_interval):
+                self.prune()
+            if len(self._live) >= self.max_masters:
+                return []
+            self._live.add(path)
+            self._pending.add(path)
+
+        # ControlMaster=auto reuses a live master or, if there isn't one,
+        # turns this connection into the master for later commands.
+        return [
+            "-o", "ControlMaster=auto",
+            "-o", "ControlPath=%s" % path,
+            "-o", "ControlPersist=%d" % self.persist,
+        ]
+
+    def settle(self, hostname):
+        """ Called once a command on hostname has finished.
+
+            If that command was meant to start a master but the master
+            never came up (e.g. the connection failed) it no longer counts
+            against the cap.
+        """
+        path = self.socket_path(hostname)
+        if path not in self._pending:
+            return
+        self._pending.discard(path)
+        if not self.is_alive(path):
+            self._live.discard(path)
+
+
+class _Lines(object):
+    """ Passes a stream's output on to hooks a line at a time."""
+
+    def __init__(self, executor, stream):
+        self.executor = executor
+        self.stream = stream
+        self.lines = LineBuffer(executor.parent.max_line)
+
+    def _update(self, lines):
+        executor = self.executor
+        for line in lines:
+            executor.update(executor.hostname, self.stream, line)
+
+    def feed(self, chunk):
+        self._update(self.lines.feed(chunk))
+
+    def flush(self):
+        self._update(self.lines.flush())
+
+
+class _Passthrough(object):
+    """ Copies a stream's output straight to gsh's own stdout or stderr."""
+
+    def __init__(self, executor, stream):
+        self.executor = executor
+        self.stream = stream
+        self.max_line = executor.parent.max_line
+        self._partial = ""
+
+    def _write(self, data):
+        metrics = self.executor.metrics
+        metrics.mark("first_byte")
+        metrics.count_chunk(self.stream, data)
+
+        writer = getattr(sys, self.stream)
+        try:
+            writer.write(data)
+            writer.flush()
+        except IOError as err:
+            if writer is not sys.stderr:
+                sys.stderr.write("Failed to write to stream %s: (%s, %s)\n" % (
+                    self.stream, err.errno, err.strerror))
+                sys.stderr.flush()
+
+    def feed(self, chunk):
+        data = self._partial + chunk if self._partial else chunk
+        end = data.rfind("\n") + 1
+        if not end and len(data) >= self.max_line:
+            end = len(data)
+        self._partial = data[end:]
+        if end:
+            self._write(data[:end])
+
+    def flush(self):
+        # As with PrinterHook, output always ends with a newline.
+        if self._partial:
+            partial, self._partial = self._partial, ""
+            self._write(partial + "\n")
+
+
+class _Child(object):
+    """ A running ssh, as tracked by the _Reactor."""
+
+    def __init__(self, proc, handles):
+        self.proc = proc
+        # fd to (pipe, _Lines or _Passthrough) for each pipe still open.
+        self.pipes = dict((pipe.fileno(), (pipe, handle)) for pipe, handle in handles)
+        self.result = AsyncResult()
+
+
+class _Reactor(object):
+    """ Watches the output pipes and exits of every ssh an executor runs.
+
+    Rather than each host having greenlets of its own reading its pipes
+    and polling for its exit, a single greenlet waits on an epoll set of
+    every open pipe, reads whichever are ready and hands their output on.
+    Once both of a child's pipes have closed it's reaped, polling every
+    reap_interval seconds until it has exited, and its return code is set
+    on child.result, waking the host's greenlet. The epoll set is only
+    held while there are children to watch.
+
+    Attributes:
+        chunk_size: Most bytes read from a pipe at once.
+        reap_interval: Seconds between checks for children which have closed
+            their pipes but not yet exited.
+    """
+
+    def __init__(self, chunk_size, reap_interval=0.005):
+        self.chunk_size = chunk_size
+        self.reap_interval = reap_interval
+        self._epoll = None
+        self._wakeup = None
+        self._fds = {}
+        self._reaping = set()
+        self._greenlet = None
+
+    def _open(self):
+        if self._epoll is not None:
+            return
+        self._epoll = select.epoll()
+        # Written to wake the reactor up when it's got something new to reap.
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._epoll.register(self._wakeup[0], select.EPOLLIN)
+
+    def close(self):
+        """ Stop watching anything and release the epoll set."""
+        if self._greenlet is not None:
+            self._greenlet.kill()
+        for child in set(self._fds.itervalues()) | self._reaping:
+            self.remove(child)
+        if self._epoll is not None:
+            self._epoll.close()
+            for fd in self._wakeup:
+                os.close(fd)
+            self._epoll = self._wakeup = None
+
+    def add(self, child):
+        self._open()
+        for fd in child.pipes:
+            self._fds[fd] = child
+            self._epoll.register(fd, select.EPOLLIN)
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+
+    def abandon(self, child):
+        """ Stop reading a child's pipes, but still reap it."""
+        for fd in list(child.pipes):
+            self._close(child, fd)
+        self._reaping.add(child)
+        if self._greenlet is None:
+            self._greenlet = gevent.spawn(self._run)
+        else:
+            try:
+                os.write(self._wakeup[1], "x")
+            except OSError:
+                pass
+
+    def remove(self, child):
+        """ Stop watching a child, closing whatever pipes it has open."""
+        for fd in list(child.pipes):
+            self._close(child, fd)
+        self._reaping.discard(child)
+
+    def _close(self, child, fd):
+        pipe, handle = child.pipes.pop(fd)
+        del self._fds[fd]
+        self._epoll.unregister(fd)
+        pipe.close()
+        handle.flush()
+
+    def _read(self, fd):
+        if fd == self._wakeup[0]:
+            try:
+                os.read(fd, 4096)
+            except OSError:
+                pass
+            return
+
+        child = self._fds.get(fd)
+        if child is None:
+            return
+        try:
+            chunk = os.read(fd, self.chunk_size)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return
+            chunk = ""
+
+        if chunk:
+            child.pipes[fd][1].feed(chunk)
+            return
+
+        self._close(child, fd)
+        if not child.pipes:
+            self._reaping.add(child)
+
+    def _reap(self):
+        for child in list(self._reaping):
+            rc = child.proc.poll()
+            if rc is not None:
+                self._reaping.discard(child)
+                child.result.set(rc)
+
+    def _run(self):
+        try:
+            while self._fds or self._reaping:
+                timeout = self.reap_interval if self._reaping else None
+                try:
+                    wait_read(self._epoll.fileno(), timeout=timeout)
+                except socket.timeout:
+                    pass
+
+                for fd, _ in self._epoll.poll(0):
+                    child = self._fds.get(fd)
+                    try:
+                        self._read(fd)
+                    except Exception as err:
+                        # Don't let one host's failure stall every other.
+                        self.remove(child)
+                        child.result.set_exception(err)
+                self._reap()
+        finally:
+            self._greenlet = None
+            if not self._fds and not self._reaping:
+                self.close()
+
 
 class SshExecutor(BaseExecutor):
+    """ Runs commands with the system's ssh client.
+
+    Output is read from ssh in chunks of up to chunk_size bytes and split
+    into lines of at most max_line bytes, so a command printing an endless
+    line, or binary data, can't make gsh buffer without bound. Output is
+    handed to hooks as the raw bytes received.
+
+    With passthrough, output isn't split into lines for hooks at all but
+    copied straight to gsh's own stdout and stderr, only holding back a
+    trailing partial line (up to max_line bytes) so output from different
+    hosts isn't interleaved mid line. This is for when output is printed
+    as is, without hostnames, and nothing else wants to see it.
+
+    Every ssh's pipes and exit are watched by a single _Reactor, so each
+    running host costs a process and its pipes but no greenlets beyond the
+    one Gsh runs it on. Where epoll isn't available (or reactor is turned
+    off) each host reads its own pipes on greenlets of its own instead.
+
+    Options:
+        chunk_size: Most bytes read from ssh at once (default: 65536).
+        max_line: Longest line passed to hooks (default: 65536).
+        passthrough: Copy output directly to stdout/stderr (default: no).
+        reactor: Watch all hosts from one greenlet (default: yes, with epoll).
+        control_master: Enable the ControlMaster connection pool.
+        control_dir, control_persist, max_masters: See _ControlMasterPool.
+        control_rescan: The pool's rescan_interval.
+    """
+
     def __init__(self, args, kwargs):
         self.ssh_opts = kwargs.get("ssh_opts", [])
+        self.chunk_size = int(kwargs.get("chunk_size", 65536))
+        self.max_line = int(kwargs.get("max_line", 65536))
+        self.passthrough = _to_bool(kwargs.get("passthrough", False))
+
+        self.reactor = None
+        if hasattr(select, "epoll") and _to_bool(kwargs.get("reactor", True)):
+            self.reactor = _Reactor(self.chunk_size)
+
+        self.control_master = None
+        if _to_bool(kwargs.get("control_master", False)):
+            self.control_master = _ControlMasterPool(
+                kwargs.get("control_dir", "~/.gsh/control"),
+                int(kwargs.get("control_persist", 600)),
+                int(kwargs.get("max_masters", 512)),
+                float(kwargs.get("control_rescan", 30)),
+            )
+
         super(SshExecutor, self).__init__(args, kwargs)
 
+    def close(self):
+        if self.reactor is not None:
+            self.reactor.close()
+
+    def build_command(self, hostname, command):
+        """ Builds the ssh command line used to run command on hostname."""
+        ssh_opts = list(self.ssh_opts)
+        if self.control_master is not None:
+            ssh_opts.extend(self.control_master.options(hostname))
+        return ["ssh", "-no", "PasswordAuthentication=no"] + ssh_opts + [hostname] + command
+
     class Executor(BaseInnerExecutor):
         def __init__(self, *args, **kwargs):
-            self.names = {}
-            self._output_queue = Queue()
             super(SshExecutor.Executor, self).__init__(*args, **kwargs)
+            self._proc = None
+            self._child = None
+            self._readers = []
 
-        @staticmethod
-        def _stream_fd(fd, queue):
-            for line in iter(fd.readline, b""):
-                queue.put_nowait((fd, line))
+        def _handle(self, stream):
+            if self.parent.passthrough:
+                return _Passthrough(self, stream)
+            return _Lines(self, stream)
 
-        def _consume(self, queue):
-            while True:
-                try:
-                    output = queue.get()
-                except Empty:
-                    continue
+        def _timed_out(self, proc):
+            self.update(self.hostname, "stderr",
+                        "GSH: command timed out after %s second(s).\n" % self.timeout)
+            proc.kill()
+            proc.wait()
+            # ssh may have exited on its own just before the kill, but the
+            # host still timed out.
+            return -9
 
-                # None is explicitly sent to shutdown the consumer
-                if output is None:
-                    return
+        def _read(self, pipe, stream):
+            """ Read one of ssh's pipes in chunks until it's closed."""
+            fd = pipe.fileno()
+            handle = self._handle(stream)
 
-                fd, line = output
-                self.update(self.hostname, self.names[fd], line)
+            try:
+                while True:
+                    try:
+                        chunk = os.read(fd, self.parent.chunk_size)
+                    except OSError as err:
+                        if err.errno != errno.EAGAIN:
+                            raise
+                        wait_read(fd)
+                        continue
+                    if not chunk:
+                        break
+                    handle.feed(chunk)
+            finally:
+                handle.flush()
 
-        def run(self):
-            _proc = Popen(
-                ["ssh", "-no", "PasswordAuthentication=no"] + self.parent.ssh_opts + [self.hostname] + self.command,
-                stdout=PIPE, stderr=PIPE
-            )
+        def _run_greenlets(self, proc):
+            readers = self._readers = [
+                gevent.spawn(self._read, proc.stdout, "stdout"),
+                gevent.spawn(self._read, proc.stderr, "stderr"),
+            ]
+            waiter = gevent.spawn(proc.wait)
 
-            self.names = {
-                _proc.stdout: "stdout",
-                _proc.stderr: "stderr",
-            }
+            gevent.joinall(readers + [waiter], timeout=self.timeout)
 
-            out_worker = gevent.spawn(self._stream_fd, _proc.stdout, self._output_queue)
-            err_worker = gevent.spawn(self._stream_fd, _proc.stderr, self._output_queue)
-            waiter = gevent.spawn(_proc.wait)
-            consumer = gevent.spawn(self._consume, self._output_queue)
+            # If we've made it here and the process hasn't completed we've timed out.
+            if proc.poll() is None:
+                rc = self._timed_out(proc)
+            else:
+                rc = proc.wait()
 
-            gevent.joinall([out_worker, err_worker, waiter], timeout=self.timeout)
+            # Anything ssh left running (a ControlPersist master for
+            # instance) may hold its pipes open, so don't wait on them forever.
+            gevent.joinall(readers, timeout=1)
+            gevent.killall(readers)
+            return rc
 
-            # If we've made it here and the process hasn't completed we've timed out.
-            if _proc.poll() is None:
-                self._output_queue.put_nowait(
-                    (_proc.stderr, "GSH: command timed out after %s second(s).\n" % self.timeout))
-                _proc.kill()
+        def _run_reactor(self, proc):
+            reactor = self.parent.reactor
+            child = self._child = _Child(proc, [
+                (proc.stdout, self._handle("stdout")),
+                (proc.stderr, self._handle("stderr")),
+            ])
+            reactor.add(child)
+
+            try:
+                return child.result.get(timeout=self.timeout)
+            except gevent.Timeout:
+                rc = self._timed_out(proc)
+                reactor.remove(child)
+                return rc
+            finally:
+                # Only still watched if something went wrong here.
+                if not child.result.ready():
+                    reactor.remove(child)
 
-            rc = _proc.wait()
+        def run(self):
+            _proc = self._proc = Popen(
+                self.parent.build_command(self.hostname, self.command),
+                stdout=PIPE, stderr=PIPE
+            )
+            self.metrics.mark("spawned")
 
-            self._output_queue.put_nowait(None)
-            consumer.join()
+            if self.parent.reactor is not None:
+                rc = self._run_reactor(_proc)
+            else:
+                rc = self._run_greenlets(_proc)
+
+            if self.parent.control_master is not None:
+                self.parent.control_master.settle(self.hostname)
 
             return rc
+
+        def cancel(self):
+            if self._proc is None or self._proc.poll() is not None:
+                return
+            self._proc.kill()
+            # Don't wait on anything ssh left holding its pipes open.
+            if self._child is not None:
+                self.parent.reactor.abandon(self._child)
+            gevent.killall(self._readers, block=False)
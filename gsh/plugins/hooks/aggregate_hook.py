@@ -0,0 +1,124 @@
+import hashlib
+import sys
+import tempfile
+
+from gsh.hostrange import compress
+from gsh.plugin import BaseExecutionHook
+
+
+class _StreamDigest(object):
+    """ One stream of a host's output, hashed as it arrives.
+
+    The output itself is spooled, in memory up to spool_size bytes and on
+    disk beyond that, until the host finishes and we know whether another
+    host already produced the same output.
+    """
+
+    def __init__(self, spool_size):
+        self.hash = hashlib.sha1()
+        self.spool = tempfile.SpooledTemporaryFile(spool_size)
+        self.size = 0
+
+    def write(self, line):
+        if isinstance(line, unicode):
+            line = line.encode("utf-8")
+        if not line.endswith("\n"):
+            line += "\n"
+        self.hash.update(line)
+        self.spool.write(line)
+        self.size += len(line)
+
+
+class _Group(object):
+    """ Hosts which produced identical output."""
+
+    def __init__(self, rc, stdout, stderr):
+        self.rc = rc
+        self.stdout = stdout
+        self.stderr = stderr
+        self.hosts = []
+
+
+class AggregateHook(BaseExecutionHook):
+    """ Groups hosts with identical output, like dshbak -c.
+
+    Each host's stdout and stderr are hashed incrementally as they arrive.
+    When a host finishes, its output (and, unless ignore_rc is set, its
+    return code) is matched against the outputs already seen. A new output
+    is kept, once, for the summary while a repeated one is thrown away, so
+    the output held is proportional to the number of distinct outputs and
+    the hosts in flight rather than all hosts. At post_job each distinct
+    output is printed once under a compact range of the hosts that produced
+    it, the most common first.
+
+    Options:
+        spool_size: Bytes of a single output kept in memory before spooling
+            it to disk (default: 65536).
+        ignore_rc: Group hosts regardless of return code (default: False).
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.spool_size = int(kwargs.pop("spool_size", 65536))
+        self.ignore_rc = kwargs.pop("ignore_rc", False) in (True, "1", "yes", "true")
+        self.output = kwargs.pop("output", sys.stdout)
+
+        self.groups = {}
+        self._hosts = {}
+
+        super(AggregateHook, self).__init__(*args, **kwargs)
+
+    def pre_host(self, hostname, timestamp):
+        self._hosts[hostname] = {
+            "stdout": _StreamDigest(self.spool_size),
+            "stderr": _StreamDigest(self.spool_size),
+        }
+
+    def update_host_batch(self, hostname, lines):
+        streams = self._hosts.get(hostname)
+        if streams is None:
+            return
+        for stream, line in lines:
+            if stream in streams:
+                streams[stream].write(line)
+
+    def update_host(self, hostname, stream, line):
+        self.update_host_batch(hostname, [(stream, line)])
+
+    def post_host(self, hostname, return_code, timestamp):
+        streams = self._hosts.pop(hostname, None)
+        if streams is None:
+            return
+        stdout, stderr = streams["stdout"], streams["stderr"]
+
+        rc = None if self.ignore_rc else return_code
+        key = (rc, stdout.hash.digest(), stderr.hash.digest())
+
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = _Group(rc, stdout, stderr)
+        else:
+            stdout.spool.close()
+            stderr.spool.close()
+        group.hosts.append(hostname)
+
+    def post_job(self, timestamp):
+        groups = sorted(self.groups.itervalues(), key=lambda group: (-len(group.hosts), group.hosts))
+        for group in groups:
+            self.write_group(group)
+        self.output.flush()
+
+    def write_group(self, group):
+        header = "%s (%d)" % (",".join(compress(group.hosts)), len(group.hosts))
+        if group.rc:
+            header += " rc=%s" % group.rc
+        rule = "-" * min(max(len(header), 16), 79)
+
+        self.output.write("%s\n%s\n%s\n" % (rule, header, rule))
+        for stream in (group.stdout, group.stderr):
+            stream.spool.seek(0)
+            while True:
+                chunk = stream.spool.read(65536)
+                if not chunk:
+                    break
+                self.output.write(chunk)
+            stream.spool.close()
@@ -1,3 +1,8 @@
+import array
+import collections
+import os
+import tempfile
+
 from gsh.plugin import BaseExecutionHook
 
 class BufferedOutputHook(BaseExecutionHook):
@@ -15,6 +20,11 @@ class BufferedOutputHook(BaseExecutionHook):
             return
         getattr(self, stream).append(line)
 
+    def update_host_batch(self, hostname, lines):
+        for stream, line in lines:
+            if stream in ("stdout", "stderr"):
+                getattr(self, stream).append(line)
+
     def post_host(self, hostname, rc, timestamp):
         self.rc = rc
 
@@ -33,7 +43,241 @@ class MultiBufferedOutputHook(BaseExecutionHook):
     def update_host(self, hostname, *args, **kwargs):
         self.hosts[hostname].update_host(hostname, *args, **kwargs)
 
+    def update_host_batch(self, hostname, lines):
+        self.hosts[hostname].update_host_batch(hostname, lines)
+
     def post_host(self, hostname, *args, **kwargs):
         self.hosts[hostname].post_host(hostname, *args, **kwargs)
 
 
+class _Spool(object):
+    """ Storage shared by the output buffers of every host in a job.
+
+    Output is held in memory until, across all buffers, more than
+    spill_size bytes are waiting, at which point every buffer is moved out
+    to a single temporary file. This also enforces the cap on how much
+    output is retained for the whole job.
+    """
+
+    def __init__(self, spill_size=64 * 1024 * 1024, max_bytes=None):
+        self.spill_size = spill_size
+        self.max_bytes = max_bytes
+        self.memory = 0
+        self.retained = 0
+        self._file = None
+        self._buffers = set()
+
+    def reserve(self, size):
+        """ Claim size bytes of the job's output cap."""
+        if self.max_bytes is not None and self.retained + size > self.max_bytes:
+            return False
+        self.retained += size
+        return True
+
+    def added(self, buf, size):
+        self.memory += size
+        self._buffers.add(buf)
+        if self.memory > self.spill_size:
+            self.spill()
+
+    def spill(self):
+        """ Move all output held in memory to the spill file."""
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix="gsh-")
+        self._file.seek(0, os.SEEK_END)
+
+        for buf in self._buffers:
+            buf.segments.append((self._file.tell(), len(buf.data)))
+            self._file.write(buf.data)
+            buf.data = bytearray()
+
+        self._buffers.clear()
+        self.memory = 0
+
+    def read(self, offset, length):
+        if self._file is None:
+            raise ValueError("Output spool has been closed.")
+        self._file.seek(offset)
+        return self._file.read(length)
+
+    def close(self):
+        """ Release the spill file, and with it any output spilled to it."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _StreamBuffer(object):
+    """ Compact storage for the lines of a single output stream.
+
+    Lines are kept back to back in one contiguous byte buffer (or in the
+    spool's file once spilled) with only their lengths stored alongside.
+    The first head_lines lines are retained, as budget allows, after which
+    only the most recent tail_lines lines are kept.
+    """
+
+    def __init__(self, owner, spool, head_lines=None, tail_lines=0):
+        self.owner = owner
+        self.spool = spool
+        self.head_lines = head_lines
+        self.data = bytearray()
+        self.segments = []
+        self.dropped = 0
+
+        self._lengths = array.array("L")
+        self._head_open = True
+        self._tail = collections.deque(maxlen=tail_lines) if tail_lines else None
+
+    def append(self, line):
+        if isinstance(line, unicode):
+            line = line.encode("utf-8")
+
+        if self._head_open:
+            if self.head_lines is not None and len(self._lengths) >= self.head_lines:
+                self._head_open = False
+            elif not self.owner.reserve(len(line)):
+                self._head_open = False
+            else:
+                self.data.extend(line)
+                self._lengths.append(len(line))
+                self.spool.added(self, len(line))
+                return
+
+        if self._tail is not None:
+            if len(self._tail) == self._tail.maxlen:
+                self.dropped += 1
+            self._tail.append(line)
+        else:
+            self.dropped += 1
+
+    def lines(self):
+        chunks = [self.spool.read(offset, length) for offset, length in self.segments]
+        chunks.append(str(self.data))
+        data = "".join(chunks)
+
+        lines = []
+        start = 0
+        for length in self._lengths:
+            lines.append(data[start:start + length])
+            start += length
+
+        if self._tail is not None:
+            lines.extend(self._tail)
+        return lines
+
+
+class BoundedBufferedOutputHook(BaseExecutionHook):
+    """ Memory-bounded version of BufferedOutputHook.
+
+    Output is stored compactly, spilled to disk past a threshold and can be
+    capped, while keeping the same .stdout/.stderr/.rc attributes. The
+    stdout and stderr lists are rebuilt each time they are accessed, so
+    hold on to them rather than reading them repeatedly. close() releases
+    the spill file once the output is no longer needed.
+
+    Attributes:
+        head_lines: Number of lines to keep from the start of each stream.
+        tail_lines: Number of lines to keep from the end of each stream
+            once head_lines, or the byte caps, have been reached.
+        max_bytes: Cap on bytes retained from this host's head lines.
+        dropped: Number of lines discarded because of the caps.
+    """
+
+    show_cli = False
+
+    def __init__(self, head_lines=None, tail_lines=0, max_bytes=None,
+                 spill_size=64 * 1024 * 1024, spool=None):
+        self.max_bytes = max_bytes
+        self.retained = 0
+        self.rc = None
+
+        self._owns_spool = spool is None
+        self._spool = _Spool(spill_size) if spool is None else spool
+        self._streams = {
+            "stdout": _StreamBuffer(self, self._spool, head_lines, tail_lines),
+            "stderr": _StreamBuffer(self, self._spool, head_lines, tail_lines),
+        }
+
+    @property
+    def stdout(self):
+        return self._streams["stdout"].lines()
+
+    @property
+    def stderr(self):
+        return self._streams["stderr"].lines()
+
+    @property
+    def dropped(self):
+        return sum(stream.dropped for stream in self._streams.itervalues())
+
+    def reserve(self, size):
+        if self.max_bytes is not None and self.retained + size > self.max_bytes:
+            return False
+        if not self._spool.reserve(size):
+            return False
+        self.retained += size
+        return True
+
+    def update_host(self, hostname, stream, line):
+        if stream in self._streams:
+            self._streams[stream].append(line)
+
+    def update_host_batch(self, hostname, lines):
+        for stream, line in lines:
+            if stream in self._streams:
+                self._streams[stream].append(line)
+
+    def post_host(self, hostname, rc, timestamp):
+        self.rc = rc
+
+    def close(self):
+        """ Release the spill file, unless it's shared with other hosts."""
+        if self._owns_spool:
+            self._spool.close()
+
+
+class BoundedMultiBufferedOutputHook(BaseExecutionHook):
+    """ Memory-bounded version of MultiBufferedOutputHook.
+
+    Every host's output is spilled to one shared file, released by close()
+    once the output is no longer needed.
+
+    Attributes:
+        hosts: A dict of hostname to BoundedBufferedOutputHook.
+
+    Args:
+        head_lines, tail_lines: Per host, per stream line retention.
+        host_bytes: Cap on bytes retained per host.
+        max_bytes: Cap on bytes retained across all hosts.
+        spill_size: Bytes of output to hold in memory, across all hosts,
+            before spilling to a temporary file.
+    """
+
+    show_cli = False
+
+    def __init__(self, head_lines=None, tail_lines=0, host_bytes=None,
+                 max_bytes=None, spill_size=64 * 1024 * 1024):
+        self.hosts = {}
+        self._spool = _Spool(spill_size, max_bytes)
+        self._host_options = {
+            "head_lines": head_lines,
+            "tail_lines": tail_lines,
+            "max_bytes": host_bytes,
+        }
+
+    def pre_host(self, hostname, timestamp):
+        self.hosts[hostname] = BoundedBufferedOutputHook(
+            spool=self._spool, **self._host_options)
+
+    def update_host(self, hostname, *args, **kwargs):
+        self.hosts[hostname].update_host(hostname, *args, **kwargs)
+
+    def update_host_batch(self, hostname, lines):
+        self.hosts[hostname].update_host_batch(hostname, lines)
+
+    def post_host(self, hostname, *args, **kwargs):
+        self.hosts[hostname].post_host(hostname, *args, **kwargs)
+
+    def close(self):
+        """ Release the spill file shared by every host's output."""
+        self._spool.close()
@@ -0,0 +1,152 @@
+import json
+import os
+import sys
+import tempfile
+
+from gsh.metrics import HostMetrics, percentile
+from gsh.plugin import BaseExecutionHook
+
+
+class MetricsHook(BaseExecutionHook):
+    """ Writes a summary of a job's per-host timings once it finishes.
+
+    The summary has the job's duration, host counts, totals of output and,
+    for each phase of HostMetrics.PHASES, the p50/p90/p95/p99/max across
+    hosts along with the slowest hosts. It's written as JSON or, with
+    format=prometheus, in the Prometheus text format for node_exporter's
+    textfile collector. Files are replaced atomically so a reader never
+    sees a partial summary.
+
+    Options (e.g. hook_options: {metrics: {path: /tmp/gsh.json}}):
+        path: Where to write the summary. Defaults to stderr.
+        format: "json" (default) or "prometheus".
+        slowest: How many of the slowest hosts to list (default: 10).
+        name: Value of the name label on Prometheus metrics (default: gsh).
+    """
+
+    wants_metrics = True
+
+    QUANTILES = (50, 90, 95, 99, 100)
+
+    def __init__(self, *args, **kwargs):
+        self.path = kwargs.pop("path", None)
+        self.format = kwargs.pop("format", "json")
+        self.slowest = int(kwargs.pop("slowest", 10))
+        self.name = kwargs.pop("name", "gsh")
+        if self.format not in ("json", "prometheus"):
+            raise ValueError("Unknown MetricsHook format: %s" % self.format)
+
+        self.start_time = None
+        self.hosts = []
+        self.failed = 0
+
+        super(MetricsHook, self).__init__(*args, **kwargs)
+
+    def pre_job(self, command, hosts, timestamp):
+        self.start_time = timestamp
+
+    def post_host(self, hostname, return_code, timestamp, metrics=None):
+        if return_code:
+            self.failed += 1
+        if metrics is not None:
+            self.hosts.append(metrics.as_dict())
+
+    def post_job(self, timestamp):
+        summary = self.summarize(timestamp)
+        if self.format == "prometheus":
+            self.write(self.prometheus(summary))
+        else:
+            self.write(json.dumps(summary, indent=2, sort_keys=True) + "\n")
+
+    def summarize(self, timestamp):
+        """ Returns the job summary as a dict."""
+        summary = {
+            "timestamp": timestamp,
+            "duration": timestamp - self.start_time if self.start_time else None,
+            "hosts": len(self.hosts),
+            "failed": self.failed,
+            "output": {},
+            "phases": {},
+        }
+
+        for counter in ("stdout_bytes", "stdout_lines", "stderr_bytes", "stderr_lines"):
+            summary["output"][counter] = sum(host[counter] for host in self.hosts)
+
+        for phase, _, _ in HostMetrics.PHASES:
+            timed = [
+                (host["durations"][phase], host["hostname"]) for host in self.hosts
+                if host["durations"].get(phase) is not None
+            ]
+            if not timed:
+                continue
+            timed.sort()
+            values = [duration for duration, _ in timed]
+            summary["phases"][phase] = {
+                "count": len(values),
+                "quantiles": dict(
+                    ("p%d" % pct if pct < 100 else "max", percentile(values, pct))
+                    for pct in self.QUANTILES
+                ),
+                "slowest": [
+                    {"hostname": hostname, "seconds": duration}
+                    for duration, hostname in reversed(timed[-self.slowest:])
+                ],
+            }
+
+        return summary
+
+    def prometheus(self, summary):
+        """ Returns the summary in the Prometheus text exposition format."""
+        name = self.name.replace("\\", "\\\\").replace('"', '\\"')
+        lines = []
+
+        def _metric(metric, help_text, samples):
+            lines.append("# HELP %s %s" % (metric, help_text))
+            lines.append("# TYPE %s gauge" % metric)
+            for labels, value in samples:
+                labels = [("name", name)] + labels
+                lines.append("%s{%s} %s" % (
+                    metric, ",".join('%s="%s"' % label for label in labels), repr(float(value))))
+
+        _metric("gsh_job_last_run_timestamp_seconds", "When the last gsh job finished.",
+                [([], summary["timestamp"])])
+        if summary["duration"] is not None:
+            _metric("gsh_job_duration_seconds", "How long the last gsh job took.",
+                    [([], summary["duration"])])
+        _metric("gsh_job_hosts", "Hosts run by the last gsh job.", [
+            ([("result", "success")], summary["hosts"] - summary["failed"]),
+            ([("result", "failed")], summary["failed"]),
+        ])
+        _metric("gsh_job_output_bytes", "Bytes of output from the last gsh job.", [
+            ([("stream", stream)], summary["output"]["%s_bytes" % stream])
+            for stream in ("stdout", "stderr")
+        ])
+        _metric("gsh_job_output_lines", "Lines of output from the last gsh job.", [
+            ([("stream", stream)], summary["output"]["%s_lines" % stream])
+            for stream in ("stdout", "stderr")
+        ])
+
+        samples = []
+        for phase, stats in sorted(summary["phases"].iteritems()):
+            for pct in self.QUANTILES:
+                key = "p%d" % pct if pct < 100 else "max"
+                samples.append(
+                    ([("phase", phase), ("quantile", str(pct / 100.0))], stats["quantiles"][key]))
+        if samples:
+            _metric("gsh_host_phase_seconds",
+                    "Quantiles of per-host phase durations in the last gsh job.", samples)
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, data):
+        if self.path is None:
+            sys.stderr.write(data)
+            return
+
+        path = os.path.expanduser(self.path)
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile(dir=directory, prefix=".gsh-metrics-",
+                                         delete=False) as metrics_file:
+            metrics_file.write(data)
+        os.chmod(metrics_file.name, 0644)
+        os.rename(metrics_file.name, path)
@@ -1,6 +1,9 @@
 
 import sys
 import math
+
+import gevent
+
 from gsh.plugin import BaseExecutionHook
 
 
@@ -10,11 +13,24 @@ class PrinterHook(BaseExecutionHook):
         self.show_percent = kwargs.pop("show_percent", False)
         self.add_newline = kwargs.pop("add_newline", True)
 
+        # In buffered mode output is assembled into large blocks which are
+        # written once they reach buffer_size bytes, once flush_interval
+        # seconds have passed, or when a host or the job finishes.
+        self.buffered = kwargs.pop("buffered", False)
+        self.buffer_size = kwargs.pop("buffer_size", 65536)
+        self.flush_interval = kwargs.pop("flush_interval", 0.5)
+
         self.hosts_total = 0
+        self.hosts_started = 0
         self.hosts_finished = 0
         self.hosts_percent = 0
         self.longest_len = 0
 
+        # (stream, line) in the order lines arrived, across both streams.
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._flusher = None
+
         super(PrinterHook, self).__init__(*args, **kwargs)
 
     def pre_job(self, command, hosts, timestamp):
@@ -23,26 +39,80 @@ class PrinterHook(BaseExecutionHook):
             # Add one to account for colons
             self.longest_len = len(max(hosts, key=len)) + 1
 
+    def pre_host(self, hostname, timestamp):
+        # When hosts are streamed into a job they aren't all known at
+        # pre_job so widen the hostname column as new hosts turn up.
+        self.hosts_started += 1
+        self.longest_len = max(self.longest_len, len(hostname) + 1)
+
+    # Output is taken a line at a time, rather than in batches, so it's
+    # printed as soon as it arrives when not buffered.
     def update_host(self, hostname, stream, line):
         if stream not in ("stdout", "stderr"):
             return
-        writer = getattr(sys, stream)
-        line = line.decode('utf-8')
+        line = self._format(hostname, line)
+        self._buffer.append((stream, line))
+        self._buffered_bytes += len(line)
 
-        try:
-            self._write(writer, hostname, line)
-        except IOError as err:
-            if writer is not sys.stderr:
-                output = "Failed to write to stream %s: (%s, %s)\n" % (stream, err.errno, err.strerror)
-                self._write(sys.stderr, hostname, output)
+        if not self.buffered or self._buffered_bytes >= self.buffer_size:
+            self.flush()
+        elif self._flusher is None and self._buffered_bytes:
+            self._flusher = gevent.spawn_later(self.flush_interval, self._flush_later)
 
     def post_host(self, hostname, return_code, timestamp):
         self.hosts_finished += 1
-        self.hosts_percent = int(math.ceil(float(self.hosts_finished) * 100 / self.hosts_total))
+        hosts_total = max(self.hosts_total, self.hosts_started)
+        self.hosts_percent = int(math.ceil(float(self.hosts_finished) * 100 / hosts_total))
+        self.flush()
+
+    def post_job(self, timestamp):
+        self.flush()
+
+    def flush(self):
+        """ Write out any buffered output."""
+        if self._flusher is not None and self._flusher is not gevent.getcurrent():
+            self._flusher.kill()
+        self._flusher = None
+        self._buffered_bytes = 0
+
+        buffered, self._buffer = self._buffer, []
+
+        # Consecutive lines on the same stream are written together, keeping
+        # the order of stdout relative to stderr.
+        runs = []
+        for stream, line in buffered:
+            if runs and runs[-1][0] == stream:
+                runs[-1][1].append(line)
+            else:
+                runs.append((stream, [line]))
+
+        for stream, lines in runs:
+            writer = getattr(sys, stream)
+
+            try:
+                writer.write("".join(lines))
+                writer.flush()
+            except IOError as err:
+                if writer is not sys.stderr:
+                    output = "Failed to write to stream %s: (%s, %s)\n" % (
+                        stream, err.errno, err.strerror)
+                    sys.stderr.write(output)
+                    sys.stderr.flush()
+
+    def _flush_later(self):
+        self._flusher = None
+        self.flush()
+
+    def _format(self, hostname, line):
+        # Output is passed through as the bytes we received rather than
+        # being decoded and re-encoded.
+        if isinstance(line, unicode):
+            line = line.encode("utf-8")
 
-    def _write(self, stream, hostname, line):
         if self.prepend_host:
-            line = "%%-%ss %%s" % self.longest_len % (hostname + ":", line)
+            if isinstance(hostname, unicode):
+                hostname = hostname.encode("utf-8")
+            line = "%-*s %s" % (self.longest_len, hostname + ":", line)
 
         if self.show_percent:
             line = "(%3s%%) %s" % (self.hosts_percent, line)
@@ -50,6 +120,4 @@ class PrinterHook(BaseExecutionHook):
         if self.add_newline and line and line[-1] != "\n":
             line += "\n"
 
-        line = line.encode('utf-8')
-        stream.write(line)
-        stream.flush()
+        return line
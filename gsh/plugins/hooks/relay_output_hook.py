@@ -0,0 +1,39 @@
+import sys
+
+from gsh.plugin import BaseExecutionHook
+
+
+def encode_line(line):
+    """ Escape a line of output so it fits on one line of the relay protocol."""
+    if isinstance(line, unicode):
+        line = line.encode("utf-8")
+    return line.encode("string_escape")
+
+
+class RelayOutputHook(BaseExecutionHook):
+    """ Streams output and return codes to the gsh which started this one.
+
+    Used by the relay executor: the gsh running on a relay node reports each
+    host's output and return code on stdout, one tab separated record per
+    line, which the originating gsh turns back into update_host and
+    post_host events.
+
+        O <host> <stream> <escaped line>
+        R <host> <return code>
+    """
+
+    show_cli = False
+
+    def __init__(self, *args, **kwargs):
+        self.output = kwargs.pop("output", sys.stdout)
+        super(RelayOutputHook, self).__init__(*args, **kwargs)
+
+    def update_host_batch(self, hostname, lines):
+        self.output.write("".join(
+            "O\t%s\t%s\t%s\n" % (hostname, stream, encode_line(line)) for stream, line in lines
+        ))
+        self.output.flush()
+
+    def post_host(self, hostname, return_code, timestamp):
+        self.output.write("R\t%s\t%d\n" % (hostname, return_code))
+        self.output.flush()
@@ -9,6 +9,9 @@ class FileLoader(BaseHostLoader):
     opt_metavar = "FILE"
     opt_help = "Get a list of machines from the specified file."
 
+    def cache_dependencies(self, *args):
+        return list(args)
+
     def __call__(self, *args):
         hosts = []
         for host_file in args:
@@ -25,16 +25,18 @@ class GshLoader(BaseHostLoader):
     opt_metavar = "GROUP"
     opt_help = "Get a list of machines from a GSH/DSH Group."
 
+    def cache_dependencies(self, *args):
+        # Every location matters, not just the one a group was found in, as
+        # a group file appearing in an earlier location takes precedence.
+        return [
+            os.path.join(os.path.expanduser(location), group)
+            for group in _parse_groups(args)
+            for location in GROUP_FILE_LOCATIONS
+        ]
+
     def __call__(self, *args):
         hosts = set()
-        groups = set()
-
-        for group in args:
-            group = group.replace(" ", "").strip()
-            if "," in group:
-                groups.update(group.split(","))
-            else:
-                groups.add(group)
+        groups = _parse_groups(args)
 
         for group in groups:
 
@@ -59,6 +61,17 @@ class GshLoader(BaseHostLoader):
         return hosts
 
 
+def _parse_groups(args):
+    groups = set()
+    for group in args:
+        group = group.replace(" ", "").strip()
+        if "," in group:
+            groups.update(group.split(","))
+        else:
+            groups.add(group)
+    return groups
+
+
 def _read_group_file(group_filename):
     hosts = set()
     with open(group_filename) as group_file:
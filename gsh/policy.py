@@ -0,0 +1,107 @@
+""" Rules for when a Gsh job should stop admitting hosts."""
+
+import math
+
+from .exceptions import ConfigError
+
+
+class Budget(object):
+    """ A number of hosts, either absolute ("5") or a percentage ("10%").
+
+    Attributes:
+        value: The count, or the percentage when percent is set.
+        percent: Whether value is a percentage of some total.
+    """
+
+    def __init__(self, value):
+        if isinstance(value, Budget):
+            value, percent = value.value, value.percent
+        else:
+            value = str(value).strip()
+            percent = value.endswith("%")
+            if percent:
+                value = value[:-1]
+            try:
+                value = float(value) if percent else int(value)
+            except ValueError:
+                raise ConfigError("Invalid host count: %s" % value)
+            if value < 0:
+                raise ConfigError("Host counts can't be negative: %s" % value)
+
+        self.value = value
+        self.percent = percent
+
+    def of(self, total):
+        """ The number of hosts this budget allows out of total."""
+        if not self.percent:
+            return self.value
+        return int(math.floor(total * self.value / 100.0))
+
+    def __str__(self):
+        if self.percent:
+            return "%g%%" % self.value
+        return str(self.value)
+
+
+class RunPolicy(object):
+    """ Decides when a job has failed badly enough to stop.
+
+    With a canary, the first canary hosts (a count or a percentage of all
+    hosts) are run on their own and the job only carries on to the rest if
+    no more than canary_failures of them (again a count or a percentage,
+    here of the canary hosts) failed. Separately, once more than
+    max_failures hosts (a count, or a percentage of all hosts) have failed
+    no more hosts are started. Hosts already running are always left to
+    finish.
+
+    When the hosts aren't known up front percentages of all hosts are
+    taken of the hosts started so far instead, and a percentage canary
+    can't be sized so is skipped.
+
+    Attributes:
+        canary: Budget of hosts to run before all others, or None.
+        canary_failures: Budget of canary hosts allowed to fail.
+        max_failures: Budget of hosts allowed to fail overall, or None.
+    """
+
+    def __init__(self, canary=None, canary_failures=0, max_failures=None):
+        self.canary = Budget(canary) if canary is not None else None
+        self.canary_failures = Budget(canary_failures)
+        self.max_failures = Budget(max_failures) if max_failures is not None else None
+
+    def canary_size(self, total):
+        """ The number of hosts in the canary batch, 0 for none.
+
+            Args:
+                total: The number of hosts in the job, None if unknown.
+        """
+        if self.canary is None:
+            return 0
+        if self.canary.percent:
+            if total is None:
+                return 0
+            # Any canary at all means at least one host.
+            return max(self.canary.of(total), 1)
+        return self.canary.value
+
+    def check_canary(self, failed, ran):
+        """ Returns why the job should stop after its canary batch, or None."""
+        allowed = self.canary_failures.of(ran)
+        if failed > allowed:
+            return "%d of %d canary host(s) failed, more than the %s allowed" % (
+                failed, ran, self.canary_failures)
+        return None
+
+    def check_failures(self, failed, total):
+        """ Returns why the job should stop admitting hosts, or None.
+
+            Args:
+                failed: The number of hosts that have failed so far.
+                total: The number of hosts in the job, or started so far
+                    when they aren't known up front.
+        """
+        if self.max_failures is None:
+            return None
+        if failed > self.max_failures.of(total):
+            return "%d host(s) failed, more than the %s allowed" % (failed, self.max_failures)
+        return None
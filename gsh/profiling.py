@@ -0,0 +1,162 @@
+""" Profiling of where a gsh job spends its time."""
+
+import json
+import sys
+import time
+
+import gevent
+import greenlet
+
+from .metrics import percentile
+
+
+class _Timer(object):
+    """ Count, total and worst case of a repeated measurement."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+        }
+
+
+class Profiler(object):
+    """ Measures the gevent runtime and hooks while a Gsh job runs.
+
+    While running, a greenlet wakes every `interval` seconds and records how
+    late it was woken: event loop lag, which grows when the hub is starved
+    of CPU by hooks or output handling rather than waiting on the network.
+    Greenlet switches are counted with greenlet.settrace. HookDispatcher
+    reports how long each hook method took, per hook class, and Gsh reports
+    how long hosts waited for room under the fork limit and, from each
+    host's HostMetrics, how long executors took to spawn their command.
+
+    Attributes:
+        interval: Seconds between event loop lag samples.
+        switches: Greenlet switches seen while running.
+        hooks: A dict of (hook class name, method) to _Timer.
+        pool_wait: _Timer of time hosts spent waiting under the fork limit.
+        spawn: _Timer of time executors took to spawn each host's command.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.switches = 0
+        self.hooks = {}
+        self.pool_wait = _Timer()
+        self.spawn = _Timer()
+        self.start_time = None
+        self.end_time = None
+
+        self._lag = []
+        self._monitor = None
+        self._previous_trace = None
+
+    def start(self):
+        self.start_time = time.time()
+        self._monitor = gevent.spawn(self._measure_lag)
+        self._previous_trace = greenlet.settrace(self._trace)
+
+    def stop(self):
+        if self._monitor is None:
+            return
+        greenlet.settrace(self._previous_trace)
+        self._monitor.kill()
+        self._monitor = None
+        self.end_time = time.time()
+
+    def _trace(self, event, args):
+        if event in ("switch", "throw"):
+            self.switches += 1
+        if self._previous_trace is not None:
+            self._previous_trace(event, args)
+
+    def _measure_lag(self):
+        while True:
+            expected = time.time() + self.interval
+            gevent.sleep(self.interval)
+            self._lag.append(max(time.time() - expected, 0.0))
+
+    def record_hook(self, hook, method, seconds):
+        """ Called by HookDispatcher after each hook method call."""
+        key = (type(hook).__name__, method)
+        timer = self.hooks.get(key)
+        if timer is None:
+            timer = self.hooks[key] = _Timer()
+        timer.add(seconds)
+
+    def record_pool_wait(self, seconds):
+        """ Called by Gsh with how long a host waited to be started."""
+        self.pool_wait.add(seconds)
+
+    def record_host(self, metrics):
+        """ Called by Gsh with each finished host's HostMetrics."""
+        spawn = metrics.durations()["spawn"]
+        if spawn is not None:
+            self.spawn.add(spawn)
+
+    def summary(self):
+        """ Returns the profile as a dict."""
+        lag = sorted(self._lag)
+        end_time = self.end_time or time.time()
+        return {
+            "duration": end_time - self.start_time if self.start_time else 0.0,
+            "switches": self.switches,
+            "loop_lag": {
+                "samples": len(lag),
+                "p50": percentile(lag, 50) or 0.0,
+                "p99": percentile(lag, 99) or 0.0,
+                "max": lag[-1] if lag else 0.0,
+            },
+            "hooks": dict(
+                ("%s.%s" % key, timer.as_dict()) for key, timer in self.hooks.iteritems()
+            ),
+            "pool_wait": self.pool_wait.as_dict(),
+            "spawn": self.spawn.as_dict(),
+        }
+
+    def report(self):
+        """ Returns the profile as human readable text."""
+        summary = self.summary()
+        lag = summary["loop_lag"]
+        lines = [
+            "GSH profile (%.3fs)" % summary["duration"],
+            "  greenlet switches: %d" % summary["switches"],
+            "  event loop lag: p50 %.1fms  p99 %.1fms  max %.1fms (%d samples)" % (
+                lag["p50"] * 1000, lag["p99"] * 1000, lag["max"] * 1000, lag["samples"]),
+        ]
+
+        for name in ("pool_wait", "spawn"):
+            timer = summary[name]
+            lines.append("  %s: %d hosts, mean %.1fms, max %.1fms, total %.3fs" % (
+                name.replace("_", " "), timer["count"], timer["mean"] * 1000,
+                timer["max"] * 1000, timer["total"]))
+
+        if summary["hooks"]:
+            lines.append("  hooks (by total time):")
+            hooks = sorted(summary["hooks"].iteritems(), key=lambda item: -item[1]["total"])
+            for name, timer in hooks:
+                lines.append("    %-40s %8d calls %9.3fs total %8.3fms max" % (
+                    name, timer["count"], timer["total"], timer["max"] * 1000))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path=None):
+        """ Write the report to stderr or, as JSON, to path."""
+        if path is None:
+            sys.stderr.write(self.report())
+            return
+        with open(path, "w") as profile_file:
+            json.dump(self.summary(), profile_file, indent=2, sort_keys=True)
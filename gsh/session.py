@@ -0,0 +1,126 @@
+""" Runs a sequence of commands across the same hosts."""
+
+import collections
+
+from .core import Gsh
+from .plugin import BaseExecutionHook, get_executors
+
+
+StepResult = collections.namedtuple("StepResult", ["command", "passed", "failed", "skipped"])
+
+
+class _StepResults(BaseExecutionHook):
+    """ Collects each host's return code for a step."""
+
+    show_cli = False
+
+    def __init__(self):
+        self.return_codes = {}
+
+    def post_host(self, hostname, return_code, timestamp):
+        self.return_codes[hostname] = return_code
+
+
+class Session(object):
+    """ Runs an ordered list of commands, steps, across a set of hosts.
+
+    Each step is run as a Gsh job on the hosts which passed every step
+    before it; hosts which fail (or are skipped by the policy) drop out of
+    the session. Every step shares one executor, so plugins are only set up
+    once and connections are reused between steps: by default the ssh
+    executor is used with its ControlMaster pool, so each host pays for one
+    connection setup however many steps there are.
+
+        with Session(hosts, fork_limit=32) as session:
+            session.run_steps([
+                ["service", "app", "stop"],
+                ["deploy-app"],
+                ["service", "app", "start"],
+            ])
+        print session.failed
+
+    Attributes:
+        hosts: The hosts still in the session.
+        failed: A dict of host to (step index, return code) for hosts which
+            dropped out, with a return code of None for skipped hosts.
+        steps: A StepResult for each step run so far.
+    """
+
+    def __init__(self, hosts, fork_limit=64, timeout=None, hooks=None, executor=None,
+                 policy=None):
+        self.hosts = sorted(set(hosts))
+        self.fork_limit = fork_limit
+        self.timeout = timeout
+        self.hooks = list(hooks or [])
+        self.policy = policy
+
+        self._owns_executor = executor is None
+        if executor is None:
+            executor = get_executors(lazy=True).SshExecutor([], {"control_master": True})
+        self.executor = executor
+
+        self.failed = {}
+        self.steps = []
+
+    def run(self, command, timeout=None):
+        """ Run a single step on the hosts still in the session.
+
+            Args:
+                command: The command to run, as for Gsh.
+                timeout: Overrides the session's timeout for this step.
+
+            Returns:
+                A StepResult of the command, the hosts that passed, a dict
+                of host to return code for those that failed and a list of
+                the hosts that were skipped.
+        """
+        step = len(self.steps)
+        if isinstance(command, basestring):
+            command = [command]
+
+        results = _StepResults()
+        if self.hosts:
+            job = Gsh(self.hosts, command, fork_limit=self.fork_limit,
+                      timeout=self.timeout if timeout is None else timeout,
+                      hooks=self.hooks + [results], executor=self.executor, policy=self.policy)
+            job.run_async()
+            job.wait()
+
+        return_codes = results.return_codes
+        passed = [host for host in self.hosts if return_codes.get(host) == 0]
+        failed = dict((host, rc) for host, rc in return_codes.iteritems() if rc != 0)
+        skipped = [host for host in self.hosts if host not in return_codes]
+
+        for host, rc in failed.iteritems():
+            self.failed[host] = (step, rc)
+        for host in skipped:
+            self.failed[host] = (step, None)
+
+        self.hosts = passed
+        result = StepResult(command, passed, failed, skipped)
+        self.steps.append(result)
+        return result
+
+    def run_steps(self, commands):
+        """ Run each command in turn, stopping early once no hosts are left.
+
+            Returns:
+                The StepResult of each step run.
+        """
+        results = []
+        for command in commands:
+            if not self.hosts:
+                break
+            results.append(self.run(command))
+        return results
+
+    def close(self):
+        """ Release the executor, if the session created it."""
+        if self._owns_executor:
+            self.executor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
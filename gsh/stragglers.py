@@ -0,0 +1,42 @@
+""" Timeouts derived from how long other hosts have taken."""
+
+import bisect
+
+from .metrics import percentile
+
+
+class StragglerCutoff(object):
+    """ Decides when a host has run for so long it's a straggler.
+
+    Rather than a fixed timeout, which is either too long to wait on hung
+    hosts or too short for legitimately slow ones, the cutoff follows the
+    job itself: once min_samples hosts have finished, any host running for
+    more than factor times the pct'th percentile of their durations is cut.
+    The cutoff is never less than min_cutoff seconds, so a job of very
+    quick hosts doesn't cut ones that are merely a little slower.
+
+    Attributes:
+        factor: Multiple of the percentile hosts may run for.
+        pct: The percentile of finished hosts' durations used.
+        min_samples: Finished hosts needed before any host is cut.
+        min_cutoff: Least number of seconds any host is allowed.
+    """
+
+    def __init__(self, factor=3.0, pct=95, min_samples=10, min_cutoff=1.0):
+        self.factor = float(factor)
+        self.pct = pct
+        self.min_samples = max(int(min_samples), 1)
+        self.min_cutoff = float(min_cutoff)
+        self._durations = []
+
+    def record(self, seconds):
+        """ Add the duration of a host which succeeded on its own."""
+        bisect.insort(self._durations, seconds)
+
+    def cutoff(self):
+        """ Returns the seconds hosts may run for, or None while there are
+            too few finished hosts to tell.
+        """
+        if len(self._durations) < self.min_samples:
+            return None
+        return max(self.factor * percentile(self._durations, self.pct), self.min_cutoff)
@@ -0,0 +1,59 @@
+""" Helpers for turning raw output from executors into lines."""
+
+
+class LineBuffer(object):
+    """ Incrementally splits chunks of output into lines.
+
+    Executors read output in whatever sized chunks the transport hands them.
+    This holds on to any trailing partial line until the rest of it arrives,
+    while making sure a single line (or binary output with no newlines at
+    all) can't grow without bound.
+
+    Attributes:
+        max_line: Longest line, in bytes, that will be buffered. Longer lines
+            are split into pieces of this size.
+        keepends: Whether lines keep their trailing newline.
+    """
+
+    def __init__(self, max_line=65536, keepends=True):
+        self.max_line = max_line
+        self.keepends = keepends
+        self._partial = ""
+
+    def feed(self, chunk):
+        """ Add a chunk of output.
+
+            Returns:
+                A list of the lines completed by this chunk.
+        """
+        data = self._partial + chunk if self._partial else chunk
+        lines = []
+
+        start = 0
+        end = data.find("\n")
+        while end != -1:
+            self._append(lines, data[start:end + 1])
+            start = end + 1
+            end = data.find("\n", start)
+
+        self._partial = data[start:]
+        while len(self._partial) > self.max_line:
+            lines.append(self._partial[:self.max_line])
+            self._partial = self._partial[self.max_line:]
+
+        return lines
+
+    def flush(self):
+        """ Returns whatever partial line remains once the stream has ended."""
+        partial, self._partial = self._partial, ""
+        if not partial:
+            return []
+        return [partial]
+
+    def _append(self, lines, line):
+        if not self.keepends:
+            line = line[:-1]
+        while len(line) > self.max_line:
+            lines.append(line[:self.max_line])
+            line = line[self.max_line:]
+        lines.append(line)
@@ -1,9 +1,32 @@
+import collections
+
+import gevent
+from gevent.queue import Queue, Full
+
 from core import Gsh
-from plugin import get_hooks
+from plugin import BaseExecutionHook, get_hooks
+
+
+HostResult = collections.namedtuple("HostResult", ["hostname", "rc", "stdout", "stderr", "metrics"])
+
 
-def run_remote_command(hosts, command, fork_limit=64, timeout=None):
-    hooks = get_hooks()
-    buffered_output = hooks.MultiBufferedOutputHook()
+def run_remote_command(hosts, command, fork_limit=64, timeout=None, buffer_options=None):
+    """ Run a command on hosts and return each host's buffered output.
+
+        Args:
+            buffer_options: If given, a dict of BoundedMultiBufferedOutputHook
+                arguments (head_lines, tail_lines, host_bytes, max_bytes,
+                spill_size) used to bound how much output is held onto.
+
+        Returns:
+            A dict of hostname to an object with stdout, stderr and rc
+            attributes.
+    """
+    hooks = get_hooks(lazy=True)
+    if buffer_options is None:
+        buffered_output = hooks.MultiBufferedOutputHook()
+    else:
+        buffered_output = hooks.BoundedMultiBufferedOutputHook(**buffer_options)
 
     procs = Gsh(
         hosts=hosts,
@@ -16,3 +39,119 @@ def run_remote_command(hosts, command, fork_limit=64, timeout=None):
     procs.wait()
 
     return buffered_output.hosts
+
+
+def iter_remote_command(hosts, command, fork_limit=64, timeout=None, max_pending=64,
+                        executor=None):
+    """ Run a command on hosts, yielding each host's result as it finishes.
+
+        Up to max_pending results are held for the caller. Beyond that
+        finished hosts wait, holding their place under the fork limit, so a
+        slow consumer slows the job down rather than results piling up.
+        Stopping iteration early (or closing the generator) cancels the
+        hosts still running and skips the rest.
+
+        Yields:
+            A HostResult of the hostname, return code, lists of stdout and
+            stderr lines and the host's gsh.metrics.HostMetrics.
+    """
+    return _iter_job(_ResultQueue(max_pending), hosts, command, fork_limit, timeout, executor)
+
+
+def iter_remote_output(hosts, command, fork_limit=64, timeout=None, max_pending=1024,
+                       executor=None):
+    """ Run a command on hosts, yielding output a line at a time as it arrives.
+
+        Like iter_remote_command, but nothing is buffered per host. Up to
+        max_pending events are held for the caller.
+
+        Yields:
+            (hostname, stream, line) for each line of output, and
+            (hostname, "exit", return code) as each host finishes.
+    """
+    return _iter_job(_OutputQueue(max_pending), hosts, command, fork_limit, timeout, executor)
+
+
+def _iter_job(hook, hosts, command, fork_limit, timeout, executor):
+    procs = Gsh(hosts, command, fork_limit=fork_limit, timeout=timeout, hooks=[hook],
+                executor=executor)
+    procs.run_async()
+
+    def _wait():
+        try:
+            return procs.wait()
+        finally:
+            hook.put(_DONE)
+
+    waiter = gevent.spawn(_wait)
+    try:
+        while True:
+            item = hook.queue.get()
+            if item is _DONE:
+                break
+            yield item
+        # Surface any errors raised while running the job.
+        waiter.get()
+    finally:
+        if not waiter.ready():
+            hook.close()
+            procs.cancel()
+            waiter.join()
+
+
+# Marks the end of a job's events.
+_DONE = object()
+
+
+class _QueueHook(BaseExecutionHook):
+    """ Hands events to a consumer through a bounded queue."""
+
+    show_cli = False
+
+    def __init__(self, max_pending):
+        self.queue = Queue(max(max_pending, 1))
+        self.closed = False
+
+    def put(self, item):
+        # Check back now and then in case the consumer has gone away.
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=0.1)
+            except Full:
+                continue
+            return
+
+    def close(self):
+        """ Stop handing out events, unblocking anything waiting to."""
+        self.closed = True
+
+
+class _ResultQueue(_QueueHook):
+
+    wants_metrics = True
+
+    def __init__(self, max_pending):
+        super(_ResultQueue, self).__init__(max_pending)
+        self.output = {}
+
+    def pre_host(self, hostname, timestamp):
+        self.output[hostname] = {"stdout": [], "stderr": []}
+
+    def update_host_batch(self, hostname, lines):
+        output = self.output[hostname]
+        for stream, line in lines:
+            if stream in output:
+                output[stream].append(line)
+
+    def post_host(self, hostname, return_code, timestamp, metrics=None):
+        output = self.output.pop(hostname)
+        self.put(HostResult(hostname, return_code, output["stdout"], output["stderr"], metrics))
+
+
+class _OutputQueue(_QueueHook):
+
+    def update_host(self, hostname, stream, line):
+        self.put((hostname, stream, line))
+
+    def post_host(self, hostname, return_code, timestamp):
+        self.put((hostname, "exit", return_code))